@@ -19,7 +19,8 @@ var pythonPathSep = process.platform === 'win32' ? ";" : ":";
 process.env.PYTHONPATH = [path.join(__dirname, 'dulwich'), process.env.PYTHONPATH].join(pythonPathSep);
 
 var PRINT_DIFFS = false,
-    WATCH_INTERVAL_MS = 500;
+    LOG_METRICS = !!process.env.GITVIZ_LOG_METRICS, // log gitviz.py --metrics for each render
+    WATCH_INTERVAL_MS = 500; // when polling because repowatch.py can't run
 
 var ROOT; // where to list repos from
 
@@ -52,19 +53,47 @@ app.get('/:repo/graph', function(req, res, next) {
     var repo = req.params.repo;
     if (!repo) throw 'no repo given: ' + repo;
 
-    watchRepo(repo);
+    // only blobs are marked as modified in the working tree
+    watchRepo(repo, req.query.worktree !== 'false' && req.query.blobs !== 'false');
+    var name = repo;
     repo = path.join(ROOT, repo);
 
     var extraArgs = [];
     if (req.query.blobs === 'false')
         extraArgs.push('--no-blobs');
+    if (req.query.worktree === 'false')
+        extraArgs.push('--no-worktree');
+    if (req.query.layout === 'lanes')
+        extraArgs.push('--layout=lanes');
+    if (req.query.format === 'json')
+        extraArgs.push('--format=json');
+    if (req.query.maxCommits)
+        extraArgs.push('--max-commits=' + req.query.maxCommits);
+    if (req.query.since)
+        extraArgs.push('--since=' + req.query.since);
+    if (req.query.range)
+        extraArgs.push('--range=' + req.query.range);
+    lastArgs[name] = extraArgs;
+
+    // ?base=VERSION (empty the first time) answers with JSON: the "version"
+    // of this render, and the "delta" since the base version when gitviz.py
+    // still has it, or the full "output" when it doesn't. Deltas are of the
+    // graph model, so this only goes with ?format=json.
+    if ('base' in req.query) {
+        if (req.query.format !== 'json')
+            return res.send(400, '?base= needs ?format=json');
+        return render(repo, extraArgs, {base: req.query.base || null}, function(err, output, response) {
+            if (err) return res.send(500, err);
+            res.json(response.delta ? {version: response.version, delta: response.delta}
+                                     : {version: response.version, output: output});
+        });
+    }
 
-    spawn('python', ['gitviz.py', repo].concat(extraArgs), {stderr: 'pipe'}, function(err, procRes) {
+    render(repo, extraArgs, function(err, dotOutput) {
         if (err) return res.send(500, err);
-        var dotOutput = procRes.stdout;
         if (PRINT_DIFFS)
             process.nextTick(function() { printDiff(dotOutput); });
-        res.setHeader('Content-Type', 'text/plain');
+        res.setHeader('Content-Type', req.query.format === 'json' ? 'application/json' : 'text/plain');
         res.end(dotOutput);
     });
 });
@@ -90,29 +119,155 @@ function printDiff(output) {
     fs.writeFileSync(lastOutputFile, output);
 }
 
-var _watched ={};
-function watchRepo(repo) {
-    if (_watched[repo]) return;
-    _watched[repo] = true;
+/**
+ * Renders a repository with a long-lived `gitviz.py --serve` process, so that
+ * each request doesn't pay for Python startup and reopening the repository.
+ * Requests and responses are line-delimited JSON, matched up by id.
+ */
+var render = (function() {
+    var proc = null,
+        nextId = 1,
+        pending = {},
+        buffered = '';
+
+    function start() {
+        proc = require('child_process').spawn('python', ['gitviz.py', '--serve']);
+        proc.stderr.pipe(process.stderr, {end: false});
+
+        proc.stdout.on('data', function(data) {
+            var lines = (buffered + data.toString()).split('\n');
+            buffered = lines.pop();
+            lines.forEach(function(line) {
+                if (!line) return;
+                var response = JSON.parse(line),
+                    cb = pending[response.id];
+                delete pending[response.id];
+                if (response.metrics)
+                    console.log('gitviz metrics: ' + JSON.stringify(response.metrics));
+                if (cb) cb(response.error || null, response.output, response);
+            });
+        });
+
+        proc.on('exit', function(code) {
+            var callbacks = pending;
+            proc = null;
+            pending = {};
+            buffered = '';
+            Object.keys(callbacks).forEach(function(id) {
+                callbacks[id]('gitviz.py --serve: exited with code ' + code);
+            });
+        });
+    }
+
+    // fields, if given, are added to the request (e.g. {base: version})
+    return function(repo, args, fields, cb) {
+        if (!cb) {
+            cb = fields;
+            fields = {};
+        }
+        if (!proc) start();
+
+        if (LOG_METRICS)
+            args = args.concat(['--metrics=-']);
+
+        var id = nextId++,
+            request = {id: id, repo: repo, args: args};
+        Object.keys(fields).forEach(function(key) { request[key] = fields[key]; });
+        pending[id] = cb;
+        proc.stdin.write(JSON.stringify(request) + '\n');
+    };
+})();
+
+var _watched = {}; // repo name -> its repowatch.py process, or true when polling
+function watchRepo(repo, worktree) {
+    var watcher = _watched[repo];
+    if (watcher && (watcher === true || watcher.worktree || !worktree)) return;
 
     var repodir = path.join(ROOT, repo);
     if (!dirExistsSync(repodir))
         throw 'The repository root you provided does not not exist: ' + repodir;
 
-    require('watch').watchTree(repodir, {interval: WATCH_INTERVAL_MS}, function() {
-        onChange(repo);
+    if (watcher) {
+        // it isn't watching the working tree, which is now being shown
+        watcher.replaced = true;
+        watcher.kill();
+    }
+
+    // repowatch.py only watches what the graph is drawn from, with inotify,
+    // and says what changed; where it can't run, poll the whole tree instead.
+    // With --worktree it also watches the files in the index, for the
+    // blobs marked as modified in the working tree.
+    var args = worktree ? ['repowatch.py', '--worktree', repodir] : ['repowatch.py', repodir],
+        proc = require('child_process').spawn('python', args),
+        buffered = '',
+        started = false;
+    proc.worktree = worktree;
+    _watched[repo] = proc;
+    proc.stderr.pipe(process.stderr, {end: false});
+
+    proc.stdout.on('data', function(data) {
+        var lines = (buffered + data.toString()).split('\n');
+        buffered = lines.pop();
+        lines.forEach(function(line) {
+            if (!line) return;
+            started = true;
+            onChange(repo, JSON.parse(line).changes);
+        });
+    });
+
+    proc.on('exit', function(code) {
+        if (proc.replaced) return;
+        if (started) {
+            delete _watched[repo]; // watch again on the next request
+            return;
+        }
+        _watched[repo] = true;
+        require('watch').watchTree(repodir, {interval: WATCH_INTERVAL_MS}, function() {
+            onChange(repo, ['refs', 'objects', 'index', 'worktree']);
+        });
     });
 }
 
-var timeouts = {};
-function onChange(repo) {
+var timeouts = {},
+    pendingChanges = {};
+function onChange(repo, changes) {
+    var pending = pendingChanges[repo] || (pendingChanges[repo] = {});
+    changes.forEach(function(change) { pending[change] = true; });
+
     if (timeouts[repo]) return;
     timeouts[repo] = setTimeout(function() {
         timeouts[repo] = null;
-        app.get('io').sockets.emit('change:' + repo);
+        delete pendingChanges[repo];
+        app.get('io').sockets.emit('change:' + repo, {changes: Object.keys(pending)});
+        prewarm(repo);
     }, 100);
 }
 
+/**
+ * Re-renders a repository that changed, the way it was last asked for, and
+ * throws the output away. gitviz.py --serve answers one request at a time,
+ * so a browser asking for the new graph finds its walk and layout done.
+ */
+var lastArgs = {}; // repo name -> args it was last rendered with
+function prewarm(repo) {
+    render(path.join(ROOT, repo), lastArgs[repo] || [], {quiet: true}, function(err) {
+        if (err) console.log('gitviz: prewarming ' + repo + ' failed: ' + err);
+    });
+}
+
+/**
+ * Renders every repository under ROOT in the background, so that the first
+ * view of each is served from the layout cache.
+ */
+function prewarmAll() {
+    var args = ['gitviz.py', '--batch', '--jobs=0', ROOT];
+    spawn('python', args, function(err, ret) {
+        if (err) return console.log('gitviz: prewarming repositories failed: ' + err);
+        if (LOG_METRICS)
+            console.log('gitviz batch: ' + ret.stdout.trim().split('\n').join('\ngitviz batch: '));
+    });
+}
+
 function dirExistsSync (d) {
   try { return fs.statSync(d).isDirectory(); }
   catch (er) { return false; }
@@ -168,6 +323,7 @@ if (require.main === module) {
         app.set('io', require('socket.io').listen(server));
         server.listen(app.get('port'), function(){
           console.log("giviz listening on port " + app.get('port'));
+          prewarmAll();
         });
     });
 }
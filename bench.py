@@ -0,0 +1,351 @@
+'''
+Benchmarks gitviz against synthetic repositories.
+
+A repository of the requested shape is generated with dulwich, then each
+stage of a render is timed on its own:
+
+  walk          reading and walking objects (RepoGraph.update), not
+                counting vertex_opts
+  vertex_opts   vertex_text, called while walking
+  graph         adding the walked vertices, refs and HEAD to a pydot graph
+  to_string     Graph.to_string
+  dot           dot -Txdot, without the layout cache
+
+Results are written as JSON, one object per run of the benchmark:
+
+    python bench.py --commits 2000 --fanout 4 --depth 3 --output results.json
+'''
+
+import dulwich.objects
+import dulwich.repo
+import gitviz
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+STAGES = ('walk', 'vertex_opts', 'graph', 'to_string', 'dot')
+
+AUTHOR = 'Bench Mark <bench@example.com>'
+START_TIME = 1262304000 # 2010-01-01, so generated history looks old enough
+COMMIT_INTERVAL = 3600
+
+
+class RepoGenerator(object):
+    '''Writes a repository with a synthetic history to a directory.
+
+    The working tree is fanout ** depth files, fanout to a directory, and
+    each commit changes a few of them. Every branch_every commits, a side
+    branch of branch_length commits is started, and it is merged back into
+    master afterwards.'''
+
+    def __init__(self, path, commits=100, branch_every=0, branch_length=3,
+                 fanout=4, depth=2, changes=2, blob_min=16, blob_max=4096,
+                 binary_fraction=0.0, loose_fraction=1.0, missing=0, seed=0):
+        self.path = path
+        self.commits = commits
+        self.branch_every = branch_every
+        self.branch_length = branch_length
+        self.fanout = fanout
+        self.depth = depth
+        self.changes = changes
+        self.blob_min = blob_min
+        self.blob_max = blob_max
+        self.binary_fraction = binary_fraction
+        self.loose_fraction = loose_fraction
+        self.missing = missing
+        self.random = random.Random(seed)
+
+        self.objects = {} # sha -> object, to write out at the end
+        self.num_commits = 0
+        self.commit_time = START_TIME
+
+    def generate(self):
+        'Writes the repository and returns it as a dulwich Repo.'
+
+        os.makedirs(self.path)
+        repo = dulwich.repo.Repo.init(self.path)
+
+        paths = [self.path_for_leaf(i) for i in range(self.fanout ** self.depth)]
+        files = dict((path, self.add(self.make_blob())) for path in paths)
+        head = self.commit(files, [], 'initial commit')
+
+        branches = 0
+        while self.num_commits < self.commits:
+            if self.branch_every and self.num_commits % self.branch_every == 0:
+                # a side branch, merged straight back in
+                branches += 1
+                side_files = dict(files)
+                side = head
+                for i in range(self.branch_length):
+                    if self.num_commits >= self.commits - 1: break
+                    side = self.commit(self.change(side_files, paths), [side],
+                                       'branch %d, commit %d' % (branches, i + 1))
+                if side != head:
+                    files.update(side_files)
+                    head = self.commit(files, [head, side], 'merge branch %d' % branches)
+                    repo.refs['refs/heads/branch%d' % branches] = side
+                    continue
+
+            head = self.commit(self.change(files, paths), [head], 'commit %d' % self.num_commits)
+
+        repo.refs['refs/heads/master'] = head
+        self.write(repo)
+        return repo
+
+    def path_for_leaf(self, i):
+        digits = []
+        for level in range(self.depth):
+            digits.append(i % self.fanout)
+            i //= self.fanout
+        return ''.join('d%d/' % digit for digit in digits[:-1]) + 'f%d.txt' % digits[-1]
+
+    def add(self, obj):
+        self.objects[obj.id] = obj
+        return obj.id
+
+    def make_blob(self):
+        # sizes are spread evenly on a log scale, so small files are common
+        size = int(math.exp(self.random.uniform(math.log(self.blob_min), math.log(self.blob_max))))
+        if self.random.random() < self.binary_fraction:
+            data = ''.join(chr(self.random.randrange(256)) for i in range(size))
+        else:
+            line = 'line %d of a generated file\n' % self.random.randrange(1000000)
+            data = (line * (size // len(line) + 1))[:size]
+        return dulwich.objects.Blob.from_string(data)
+
+    def change(self, files, paths):
+        for path in self.random.sample(paths, min(self.changes, len(paths))):
+            files[path] = self.add(self.make_blob())
+        return files
+
+    def make_tree(self, files):
+        'Adds the trees for a {path: blob sha} dict, and returns the root tree sha.'
+
+        root = {}
+        for path, sha in files.iteritems():
+            node = root
+            parts = path.split('/')
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = sha
+
+        def write(node):
+            tree = dulwich.objects.Tree()
+            for name, value in node.iteritems():
+                if isinstance(value, dict):
+                    tree[name] = (040000, write(value))
+                else:
+                    tree[name] = (0100644, value)
+            return self.add(tree)
+
+        return write(root)
+
+    def commit(self, files, parents, message):
+        commit = dulwich.objects.Commit()
+        commit.tree = self.make_tree(files)
+        commit.parents = parents
+        commit.author = commit.committer = AUTHOR
+        commit.author_time = commit.commit_time = self.commit_time
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.message = message + '\n'
+
+        self.commit_time += COMMIT_INTERVAL
+        self.num_commits += 1
+        return self.add(commit)
+
+    def write(self, repo):
+        '''Writes objects loose or into one pack, in the proportion asked for,
+        then deletes some blobs to leave the repository with missing objects.'''
+
+        objstore = repo.object_store
+        shas = sorted(self.objects)
+        self.random.shuffle(shas)
+
+        blobs = [sha for sha in shas if self.objects[sha].type_name == 'blob']
+        missing = set(blobs[:self.missing])
+        num_loose = int(round(len(shas) * self.loose_fraction))
+
+        loose = [sha for sha in shas if sha in missing]
+        loose.extend([sha for sha in shas if sha not in missing][:max(0, num_loose - len(loose))])
+        loose_set = set(loose)
+
+        for sha in loose:
+            objstore.add_object(self.objects[sha])
+        objstore.add_objects([(self.objects[sha], None) for sha in shas if sha not in loose_set])
+
+        for sha in missing:
+            os.remove(os.path.join(objstore.path, sha[:2], sha[2:]))
+
+class StageTimer(object):
+    'Adds up the time spent in calls to a function.'
+
+    def __init__(self, func):
+        self.func = func
+        self.seconds = 0.0
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.seconds += time.time() - start
+            self.calls += 1
+
+def time_render(repo, options):
+    '''Times each stage of one render from scratch. Returns {stage: seconds},
+    the number of vertices walked and the size of the DOT text.'''
+
+    times = {}
+
+    # vertex_text is called from deep inside the walk, so time it
+    # there and take it out of the walk's time.
+    timer = StageTimer(gitviz.vertex_text)
+    gitviz.vertex_text = timer
+    try:
+        repo_graph = gitviz.RepoGraph(repo, options)
+        start = time.time()
+        repo_graph.update()
+        times['walk'] = time.time() - start - timer.seconds
+    finally:
+        gitviz.vertex_text = timer.func
+    times['vertex_opts'] = timer.seconds
+
+    start = time.time()
+    graph, model = gitviz.build_graph(repo, options, repo_graph)
+    times['graph'] = time.time() - start
+
+    start = time.time()
+    dot_text = graph.to_string()
+    times['to_string'] = time.time() - start
+
+    start = time.time()
+    try:
+        gitviz.run_dot([dot_text])
+    except OSError:
+        times['dot'] = None # no Graphviz here
+    else:
+        times['dot'] = time.time() - start
+
+    repo_graph.builder.close()
+    return times, len(repo_graph.builder.vertices), len(dot_text)
+
+def count_objects(repo):
+    counts = {}
+    for sha in repo.object_store:
+        type_name = repo.object_store[sha].type_name
+        counts[type_name] = counts.get(type_name, 0) + 1
+    return counts
+
+def run(options, shape):
+    '''Generates a repository (unless options.repo names one) and returns the
+    benchmark results for it as a dict.'''
+
+    tmpdir = None
+    if options.repo:
+        repo = dulwich.repo.Repo(options.repo)
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='gitviz-bench-')
+        start = time.time()
+        repo = RepoGenerator(os.path.join(tmpdir, 'repo'), **shape).generate()
+        generate_seconds = time.time() - start
+
+    try:
+        render_options, _ = gitviz.make_option_parser().parse_args(options.gitviz_args)
+        render_options.index = False # generated repositories have no index
+
+        runs = []
+        for i in range(options.repeat):
+            times, num_vertices, dot_bytes = time_render(repo, render_options)
+            runs.append(times)
+
+        result = dict(
+            repo=options.repo or repo.path,
+            shape=None if options.repo else shape,
+            gitviz_args=options.gitviz_args,
+            objects=count_objects(repo),
+            vertices=num_vertices,
+            dot_bytes=dot_bytes,
+            stages=dict((stage, summarize([times[stage] for times in runs])) for stage in STAGES),
+            python=platform.python_version(),
+            dot=gitviz.dot_version() if runs[0]['dot'] is not None else None,
+            time=time.time(),
+        )
+        if tmpdir is not None:
+            result['generate_seconds'] = generate_seconds
+        return result
+    finally:
+        if tmpdir is not None and not options.keep:
+            shutil.rmtree(tmpdir)
+
+def summarize(seconds):
+    if None in seconds:
+        return None
+    return dict(min=min(seconds), max=max(seconds), mean=sum(seconds) / len(seconds), runs=seconds)
+
+def make_option_parser():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog [options] [-- GITVIZ_OPTIONS]')
+    parser.add_option("--commits", type="int", default=100,
+                      help="how many commits to generate (default %default)")
+    parser.add_option("--branch-every", type="int", default=0, metavar="N",
+                      help="start a side branch every N commits, and merge it back (default never)")
+    parser.add_option("--branch-length", type="int", default=3, metavar="N",
+                      help="how many commits each side branch gets (default %default)")
+    parser.add_option("--fanout", type="int", default=4,
+                      help="files or subdirectories per directory (default %default)")
+    parser.add_option("--depth", type="int", default=2,
+                      help="levels of directories, counting the files (default %default)")
+    parser.add_option("--changes", type="int", default=2,
+                      help="files changed by each commit (default %default)")
+    parser.add_option("--blob-min", type="int", default=16, metavar="BYTES",
+                      help="smallest blob to generate (default %default)")
+    parser.add_option("--blob-max", type="int", default=4096, metavar="BYTES",
+                      help="largest blob to generate (default %default)")
+    parser.add_option("--binary-fraction", type="float", default=0.0, metavar="FRACTION",
+                      help="fraction of blobs that are binary (default %default)")
+    parser.add_option("--loose-fraction", type="float", default=1.0, metavar="FRACTION",
+                      help="fraction of objects written loose; the rest go in a pack (default %default)")
+    parser.add_option("--missing", type="int", default=0, metavar="N",
+                      help="delete N blobs after writing them (default %default)")
+    parser.add_option("--seed", type="int", default=0,
+                      help="random seed, so the same options make the same repository")
+    parser.add_option("--repo", metavar="DIR",
+                      help="benchmark an existing repository instead of generating one")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="how many times to time each stage (default %default)")
+    parser.add_option("--keep", action="store_true", default=False,
+                      help="don't delete the generated repository")
+    parser.add_option("--output", metavar="FILE",
+                      help="append results to FILE as a line of JSON, instead of printing them")
+    return parser
+
+SHAPE_OPTIONS = ('commits', 'branch_every', 'branch_length', 'fanout', 'depth', 'changes',
+                 'blob_min', 'blob_max', 'binary_fraction', 'loose_fraction', 'missing', 'seed')
+
+def main():
+    parser = make_option_parser()
+    options, args = parser.parse_args()
+    options.gitviz_args = args
+    if options.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    shape = dict((name, getattr(options, name)) for name in SHAPE_OPTIONS)
+    result = json.dumps(run(options, shape), sort_keys=True)
+
+    if options.output:
+        f = open(options.output, 'a')
+        try:
+            f.write(result + '\n')
+        finally:
+            f.close()
+    else:
+        print result
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,500 @@
+'''
+Low-level reads from a dulwich object store that don't inflate whole objects.
+'''
+
+import collections
+import dulwich.lru_cache
+import dulwich.object_store
+import dulwich.objects
+import dulwich.pack
+import mmap
+import multiprocessing
+import os
+import zlib
+
+HEADER_READ_SIZE = 64 # enough bytes to hold any pack entry or loose object header
+CHUNK_SIZE = 4096 # how much compressed data to feed zlib at a time when streaming
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DECODE_CHUNK_SIZE = 2048 # how many shas to hand a decoding process at a time
+
+
+def type_name_for_num(type_num):
+    return dulwich.objects.object_class(type_num).type_name
+
+def loose_object_path(objstore, sha):
+    return os.path.join(objstore.path, sha[:2], sha[2:])
+
+def loose_object_header(path):
+    '''Returns (type_name, size) for the loose object at path, only inflating
+    as much of it as it takes to read the header.'''
+
+    f = open(path, 'rb')
+    try:
+        decomp = zlib.decompressobj()
+        header = ''
+        while '\0' not in header:
+            chunk = f.read(HEADER_READ_SIZE)
+            if not chunk:
+                raise ValueError('truncated loose object: %s' % path)
+            header += decomp.decompress(chunk, HEADER_READ_SIZE)
+            if len(header) > HEADER_READ_SIZE:
+                raise ValueError('bad loose object header: %s' % path)
+    finally:
+        f.close()
+
+    type_name, size = header[:header.index('\0')].split(' ', 1)
+    return type_name, int(size)
+
+def inflate_prefix(chunks, limit):
+    '''Inflates at most limit bytes from an iterable of chunks of zlib data,
+    reading no more of the chunks than it takes to do so.'''
+
+    decomp = zlib.decompressobj()
+    out = []
+    remaining = limit
+    for chunk in chunks:
+        while chunk and remaining > 0:
+            data = decomp.decompress(chunk, remaining)
+            out.append(data)
+            remaining -= len(data)
+            chunk = decomp.unconsumed_tail
+        if remaining <= 0 or decomp.unused_data:
+            break
+
+    return ''.join(out)
+
+class BlobPrefix(object):
+    '''The first bytes of a blob, standing in for a whole dulwich Blob when
+    all we want is a label.'''
+
+    type_name = 'blob'
+
+    def __init__(self, id, size, data):
+        self.id = id
+        self.size = size
+        self.data = data
+
+    def is_binary(self):
+        # the same heuristic git uses, but over fewer bytes
+        return '\0' in self.data
+
+def read_packed_refs(path):
+    '''Returns {name: (sha, peeled)} for the refs in a packed-refs file, read in
+    one pass. peeled is what an annotated tag points at, the ref's own sha for
+    refs the file says aren't annotated tags, and None when it doesn't say.'''
+
+    refs = {}
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return refs
+
+    try:
+        traits = ()
+        name = None
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                if line.startswith('# pack-refs with:'):
+                    traits = line.split(':', 1)[1].split()
+                continue
+            if line.startswith('^'):
+                if name is not None:
+                    refs[name] = (refs[name][0], line[1:])
+                continue
+
+            sha, name = line.split(' ', 1)
+            # with 'peeled', tags with no ^ line aren't annotated, and with
+            # 'fully-peeled' the same goes for every ref.
+            if 'fully-peeled' in traits or ('peeled' in traits and name.startswith('refs/tags/')):
+                refs[name] = (sha, sha)
+            else:
+                refs[name] = (sha, None)
+    finally:
+        f.close()
+
+    return refs
+
+def read_refs(controldir):
+    '''Returns {name: (sha, peeled)} for every ref under refs/ in a repository,
+    without going through a refs container one ref at a time.
+
+    packed-refs is read in one pass (see read_packed_refs), then loose refs,
+    which take precedence. Loose refs don't say whether they are annotated
+    tags, so their peeled value is None. Symbolic refs get the value of the
+    ref they point at, and dangling ones are left out.'''
+
+    refs = read_packed_refs(os.path.join(controldir, 'packed-refs'))
+    symrefs = {}
+
+    for dirpath, dirnames, filenames in os.walk(os.path.join(controldir, 'refs')):
+        for filename in filenames:
+            if filename.endswith('.lock'): continue
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, controldir).replace(os.sep, '/')
+            try:
+                f = open(path, 'rb')
+                try:
+                    contents = f.read(256).strip()
+                finally:
+                    f.close()
+            except IOError:
+                continue # deleted while we were looking
+            if contents.startswith('ref: '):
+                symrefs[name] = contents[5:]
+            elif len(contents) == 40:
+                refs[name] = (contents, None)
+
+    for name, target in symrefs.iteritems():
+        for i in xrange(5): # as deep as git follows them
+            if target not in symrefs: break
+            target = symrefs[target]
+        if target in refs:
+            refs[name] = refs[target]
+
+    return refs
+
+class CommitSummary(collections.namedtuple('CommitSummary', 'id tree parents commit_time message')):
+    '''Just the parts of a commit that a walk needs, small and cheap to pickle
+    back from a decoding process.'''
+
+    __slots__ = ()
+    type_name = 'commit'
+
+class TreeSummary(collections.namedtuple('TreeSummary', 'id items')):
+    '''A tree's (mode, name, sha) entries, standing in for a dulwich Tree.'''
+
+    __slots__ = ()
+    type_name = 'tree'
+
+    def entries(self):
+        return list(self.items)
+
+class PackHeaders(object):
+    '''Reads object types and sizes from the entry headers of one pack file.
+
+    Deltified entries are followed back to their base entry, reading only
+    headers along the way, so nothing is ever inflated.'''
+
+    def __init__(self, basename):
+        self.index = dulwich.pack.load_pack_index(basename + '.idx')
+        f = open(basename + '.pack', 'rb')
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        self._type_nums = {} # offset -> resolved type number
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def header_at(self, offset):
+        '''Returns (type_num, size, base, data_offset) for the entry at offset.
+        base is the offset of the delta base for OFS_DELTA entries, its binary
+        sha for REF_DELTA entries, and None otherwise. size is the inflated
+        size of the entry itself, which for deltas is the size of the delta.
+        data_offset is where the entry's zlib data starts.'''
+
+        data = self.data[offset:offset + HEADER_READ_SIZE]
+        byte = ord(data[0])
+        type_num = (byte >> 4) & 0x07
+        size = byte & 0x0f
+        shift = 4
+        i = 1
+        while byte & 0x80:
+            byte = ord(data[i])
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            i += 1
+
+        base = None
+        if type_num == dulwich.pack.OFS_DELTA:
+            byte = ord(data[i])
+            i += 1
+            delta_offset = byte & 0x7f
+            while byte & 0x80:
+                byte = ord(data[i])
+                i += 1
+                delta_offset = ((delta_offset + 1) << 7) | (byte & 0x7f)
+            base = offset - delta_offset
+        elif type_num == dulwich.pack.REF_DELTA:
+            base = data[i:i + 20]
+            i += 20
+
+        return type_num, size, base, offset + i
+
+    def type_num_at(self, offset):
+        '''Returns the type number of the object at offset, or None if it is a
+        delta against an object outside of this pack.'''
+
+        chain = []
+        type_num = self._type_nums.get(offset)
+        while type_num is None:
+            chain.append(offset)
+            type_num, size, base, data_offset = self.header_at(offset)
+            if type_num == dulwich.pack.OFS_DELTA:
+                offset = base
+            elif type_num == dulwich.pack.REF_DELTA:
+                try:
+                    offset = self.index.object_index(base)
+                except KeyError:
+                    return None
+            else:
+                break
+            type_num = self._type_nums.get(offset)
+
+        for offset in chain:
+            self._type_nums[offset] = type_num
+
+        return type_num
+
+    def iter_types(self):
+        '''Yields (hex sha, type_name) for every object in the pack. type_name
+        is None for the rare object whose delta base lives in another pack.'''
+
+        for sha, offset, crc32 in self.index.iterentries():
+            type_num = self.type_num_at(offset)
+            type_name = type_name_for_num(type_num) if type_num is not None else None
+            yield dulwich.objects.sha_to_hex(sha), type_name
+
+    def iter_data(self, offset):
+        '''Yields the pack's bytes starting at offset, a chunk at a time.'''
+
+        end = len(self.data)
+        while offset < end:
+            yield self.data[offset:offset + CHUNK_SIZE]
+            offset += CHUNK_SIZE
+
+class ObjectReader(object):
+    '''Reads objects from a disk object store, but only the first bytes of blobs.
+
+    Loose blobs and packed blobs that aren't deltified are streamed through
+    zlib and inflation stops after the requested number of bytes. Deltified
+    blobs can't be read that way and are inflated in full.
+
+    objects_read (type_name -> count) and bytes_inflated keep running totals
+    of the reads.'''
+
+    def __init__(self, objstore):
+        self.objstore = objstore
+        self.packs = {} # pack basename -> PackHeaders
+        self.pack_dir_mtime = None
+        self.objects_read = {}
+        self.bytes_inflated = 0
+
+    def close(self):
+        for headers in self.packs.itervalues():
+            headers.close()
+        self.packs = {}
+
+    def refresh_packs(self):
+        pack_dir = self.objstore.pack_dir
+        try:
+            mtime = os.stat(pack_dir).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.pack_dir_mtime: return
+        self.pack_dir_mtime = mtime
+
+        basenames = set()
+        if mtime is not None:
+            basenames = set(os.path.join(pack_dir, f[:-len('.idx')])
+                            for f in os.listdir(pack_dir) if f.endswith('.idx'))
+
+        for basename in set(self.packs) - basenames:
+            self.packs.pop(basename).close()
+        for basename in basenames - set(self.packs):
+            self.packs[basename] = PackHeaders(basename)
+
+    def read(self, sha, limit):
+        '''Returns the object with the given sha, or a BlobPrefix holding at
+        most limit bytes of it if it is a blob. Raises KeyError if the object
+        is missing.'''
+
+        obj = self._read(sha, limit)
+        self.objects_read[obj.type_name] = self.objects_read.get(obj.type_name, 0) + 1
+        return obj
+
+    def _read(self, sha, limit):
+        path = loose_object_path(self.objstore, sha)
+        if os.path.exists(path):
+            return self.read_loose(sha, path, limit)
+
+        self.refresh_packs()
+        for headers in self.packs.itervalues():
+            try:
+                offset = headers.index.object_index(sha)
+            except KeyError:
+                continue
+            return self.read_packed(sha, headers, offset, limit)
+
+        return self.read_full(sha, limit)
+
+    def read_loose(self, sha, path, limit):
+        f = open(path, 'rb')
+        try:
+            chunks = iter(lambda: f.read(CHUNK_SIZE), '')
+            data = inflate_prefix(chunks, limit + HEADER_READ_SIZE)
+        finally:
+            f.close()
+
+        header, data = data.split('\0', 1)
+        type_name, size = header.split(' ', 1)
+        if type_name != 'blob':
+            obj = self.objstore[sha]
+            self.bytes_inflated += obj.raw_length()
+            return obj
+
+        self.bytes_inflated += len(data)
+
+        return BlobPrefix(sha, int(size), data[:limit])
+
+    def read_packed(self, sha, headers, offset, limit):
+        type_num, size, base, data_offset = headers.header_at(offset)
+        if type_num != dulwich.objects.Blob.type_num:
+            # other objects are read whole, and deltified blobs have to be.
+            return self.read_full(sha, limit)
+
+        data = inflate_prefix(headers.iter_data(data_offset), limit)
+        self.bytes_inflated += len(data)
+        return BlobPrefix(sha, size, data)
+
+    def read_full(self, sha, limit):
+        obj = self.objstore[sha]
+        self.bytes_inflated += obj.raw_length()
+        if obj.type_name != 'blob':
+            return obj
+
+        data = obj.as_raw_string()
+        return BlobPrefix(sha, len(data), data[:limit])
+
+def summarize(obj):
+    '''Returns a CommitSummary, TreeSummary or BlobPrefix for an object read by
+    an ObjectReader, or None for other types of objects.'''
+
+    if obj.type_name == 'commit':
+        return CommitSummary(obj.id, obj.tree, tuple(obj.parents), obj.commit_time, obj.message)
+    if obj.type_name == 'tree':
+        return TreeSummary(obj.id, tuple(obj.entries()))
+    if obj.type_name == 'blob':
+        return obj
+    return None
+
+_decode_reader = None # the ObjectReader of a decoding process
+
+def _init_decoder(objstore_path):
+    global _decode_reader
+    _decode_reader = ObjectReader(dulwich.object_store.DiskObjectStore(objstore_path))
+
+def _decode_chunk(args):
+    shas, limit = args
+    reader = _decode_reader
+    before = dict(reader.objects_read), reader.bytes_inflated
+
+    summaries = []
+    for sha in shas:
+        try:
+            summary = summarize(reader.read(sha, limit))
+        except KeyError:
+            continue
+        if summary is not None:
+            summaries.append(summary)
+
+    objects_read = dict((type_name, count - before[0].get(type_name, 0))
+                        for type_name, count in reader.objects_read.iteritems())
+    return summaries, objects_read, reader.bytes_inflated - before[1]
+
+def decode_objects(reader, shas, limit, jobs):
+    '''Reads the objects with the given shas in a pool of jobs processes, and
+    returns a dict of sha -> CommitSummary, TreeSummary or BlobPrefix (with at
+    most limit bytes) for the commits, trees and blobs among them.
+
+    Each process opens the object store on its own and is handed shards of
+    shas in order, so that nearby loose object directories and pack index
+    pages are read by the same process. Missing objects and other types are
+    left out for the caller to read. What the processes read is added to
+    reader's running totals.'''
+
+    shas = sorted(shas)
+    chunks = [(shas[i:i + DECODE_CHUNK_SIZE], limit) for i in xrange(0, len(shas), DECODE_CHUNK_SIZE)]
+    decoded = {}
+
+    pool = multiprocessing.Pool(jobs, _init_decoder, (reader.objstore.path,))
+    try:
+        for summaries, objects_read, bytes_inflated in pool.imap_unordered(_decode_chunk, chunks):
+            for summary in summaries:
+                decoded[summary.id] = summary
+            for type_name, count in objects_read.iteritems():
+                reader.objects_read[type_name] = reader.objects_read.get(type_name, 0) + count
+            reader.bytes_inflated += bytes_inflated
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return decoded
+
+def object_size(obj):
+    'Roughly how many bytes an object takes up in an ObjectCache.'
+
+    if isinstance(obj, BlobPrefix):
+        return len(obj.data)
+    return obj.raw_length()
+
+class ObjectCache(object):
+    '''A least-recently-used cache of objects keyed by sha, bounded by the
+    total size of the objects in it rather than by how many there are.
+
+    hits and misses count lookups, so callers can tell how often an object
+    had to be read again.'''
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._cache = dulwich.lru_cache.LRUSizeCache(max_bytes, compute_size=object_size)
+
+    def __contains__(self, sha):
+        return sha in self._cache
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._cache.resize(max_bytes)
+
+    def get(self, sha, read):
+        '''Returns the cached object for sha, calling read(sha) to get it on a
+        miss. KeyErrors from read are passed on, and nothing is cached.'''
+
+        obj = self._cache.get(sha)
+        if obj is not None:
+            self.hits += 1
+            return obj
+
+        self.misses += 1
+        obj = read(sha)
+        self._cache.add(sha, obj)
+        return obj
+
+class CachedObjectStore(object):
+    '''Just enough of a dulwich object store to read trees through an
+    ObjectCache, for code that walks trees itself (like gitviz's
+    IndexChanges). Blobs might come back as BlobPrefixes.
+
+    Misses are read with read(sha), which should be the same function the
+    cache's other users read with (like an ObjectReader's), so that reads
+    are counted in one place.'''
+
+    def __init__(self, objstore, cache, read):
+        self.objstore = objstore
+        self.cache = cache
+        self.read = read
+
+    def __getitem__(self, sha):
+        return self.cache.get(sha, self.read)
+
+    def __contains__(self, sha):
+        return sha in self.objstore
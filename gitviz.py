@@ -5,54 +5,151 @@ Reads the contents of a git repository and write a DOT graph file to stdout.
 import dulwich.repo
 import dulwich.index
 import dulwich.objects
+import dulwich.pack
+import gitstore
+import lanes
+import layoutcache
 import pydot
+import collections
+import copy
+import fnmatch
+import hashlib
+import heapq
+import json
+import multiprocessing
+import optparse
+import os
+import stat
 import subprocess
+import sys
+import threading
+import time
+import zlib
 
 DEFAULT_FONTNAME = 'Monaco'
 DEFAULT_FONTSIZE = '8'
 
 BLOB_CONTENT_LIMIT = 200 # show at most this many bytes of blob content
+DOT_PIPE_BUFSIZE = 64 * 1024 # write DOT text to dot in pieces of about this size
+WORKTREE_COLOR = '#ff8000' # outline of blobs that differ from the working tree
+REF_LABEL_LIMIT = 8 # list at most this many refs on a node that several refs share
+PARALLEL_DECODE_MIN = 20000 # with --jobs, only start processes for at least this many new objects
+REPO_GRAPH_LIMIT = 16 # walked graphs the render server keeps, dropping the least recently used
 
 DEFAULT_FONT = dict(fontname=DEFAULT_FONTNAME, fontsize=DEFAULT_FONTSIZE)
 
+# Written once as the graph's node [...] and edge [...] defaults, instead of
+# on every vertex and edge.
+NODE_DEFAULTS = dict(DEFAULT_FONT)
+EDGE_DEFAULTS = dict(labelfontsize='11', labelfloat='False', **DEFAULT_FONT)
 
-def emit_repo_as_xdot(repo, options):
-    '''Emits xdot for the given repo on stdout.'''
+# Display options shared by every vertex of a kind. Each kind that is used
+# gets an anonymous subgraph with these as its node defaults, so vertices
+# only carry the options that are their own (see VertexGroups).
+VERTEX_GROUPS = dict(
+    commit=dict(shape='note', style='filled', fillcolor='#ccffcc'),
+    tree=dict(shape='folder', label='tree', fontcolor='#a0a0a0', style='filled', fillcolor='#ffffff'),
+    blob=dict(shape='ellipse', style='filled', fillcolor='#ffffff'),
+    other=dict(shape='ellipse', style='filled', fillcolor='#ffffff'),
+    boundary=dict(label='...', shape='note', style='dashed', fontcolor='#a0a0a0'),
+    branch=dict(shape='diamond', style='filled'),
+)
 
-    global graph # TODO: globals are bad mmmmkay
-    global vertices
 
-    vertices = {}
+def emit_repo_as_xdot(repo, options, metrics=None):
+    '''Emits xdot (or JSON, with --format=json) for the given repo on stdout,
+    writing it out as it is made.'''
+
+    for chunk in iter_repo_as_xdot(repo, options, metrics=metrics):
+        sys.stdout.write(chunk)
+
+def render_repo_as_xdot(repo, options, repo_graph=None, metrics=None):
+    '''Returns xdot for the given repo as a string, or the graph model as
+    JSON with --format=json.
+
+    Pass the RepoGraph from a previous render of the same repository and
+    options to only walk the objects added since then, and a RenderMetrics
+    to find out where the time went.'''
+
+    return ''.join(iter_repo_as_xdot(repo, options, repo_graph, metrics))
+
+def iter_repo_as_xdot(repo, options, repo_graph=None, metrics=None):
+    'Yields what render_repo_as_xdot() returns, in chunks.'
+
+    if repo_graph is None:
+        repo_graph = RepoGraph(repo, options)
+    if metrics is None:
+        metrics = RenderMetrics()
+
+    graph, model = render_repo_graph(repo, options, repo_graph, metrics)
+    for chunk in iter_output(graph, model, options, metrics):
+        yield chunk
+    metrics.finish()
+
+def render_repo_graph(repo, options, repo_graph, metrics):
+    '''Updates a RepoGraph and returns (graph, model) for it: the pydot
+    graph to lay out and its GraphModel, counting what it took in metrics.'''
+
+    builder = repo_graph.builder
+    before = builder_stats(builder)
+
+    metrics.timed('walk', repo_graph.update)
+    graph, model = metrics.timed('graph', build_graph, repo, options, repo_graph)
+
+    if repo_graph.builder is not builder:
+        before = builder_stats(None) # everything was walked again from scratch
+    metrics.count_reads(before, builder_stats(repo_graph.builder))
+    metrics.count_graph(graph)
+    return graph, model
+
+def build_graph(repo, options, repo_graph):
+    '''Returns (graph, model) for an updated RepoGraph, plus the refs, HEAD
+    and the index: a pydot graph and the GraphModel with the same vertices
+    and edges.'''
 
     graph = pydot.Graph(verbose=True)
     graph.set_bgcolor('#00000000') # transparent background
+    graph.set_node_defaults(**NODE_DEFAULTS)
+    graph.set_edge_defaults(**EDGE_DEFAULTS)
+    groups = VertexGroups(graph, GraphModel())
 
-    objstore = repo.object_store
-    seen = set()
+    repo_graph.builder.add_to_graph(groups)
 
-    # walk everything in the object store. (this means orphaned nodes will show.)
-    for sha in objstore:
-        if not options.blobs and objstore[sha].type_name in ('blob', 'tree'):
-            continue
-        walk_node(objstore, seen, sha, options)
+    # tags and other refs are drawn on what they peel to, so that annotated
+    # tags share a node with everything else on the same commit.
+    shared = {} # peeled sha -> names of the tags and other refs pointing at it
+    for ref, (sha, peeled) in sorted(select_refs(repo, options).iteritems()):
+        if ref.startswith('refs/heads/'):
+            target = sha
+        elif peeled is not None:
+            target = peeled
+        else:
+            target = repo_graph.builder.peel(sha) # not in packed-refs, so read the tag
+        if windowed(options) and target not in repo_graph.builder.vertices:
+            continue # points outside the window
+        if ref.startswith('refs/heads/'):
+            add_branch_node(groups, ref)
+            groups.add_edge(ref, sha, style='dotted')
+        else:
+            shared.setdefault(target, []).append(ref)
 
-    for ref in repo.refs.keys():
-        if ref == 'HEAD': continue # TODO: let this loop handle symbolic refs too
-        branch_node = add_branch_node(ref)
-        graph.add_edge(pydot.Edge(branch_node, repo.refs[ref], **edge_opts(style='dotted')))
+    for sha, names in sorted(shared.iteritems(), key=lambda item: item[1]):
+        refs_name = add_refs_node(groups, sha, names)
+        groups.add_edge(refs_name, sha, style='dotted')
 
     # do HEAD as a special case
     ref = 'HEAD'
-    nopts = node_opts(label=ref, shape='diamond', style='filled', fillcolor='#ff3333', fontcolor='white', tooltip='Symbolic Ref: HEAD')
-    head_node = pydot.Node(ref, **nopts)
-    graph.add_node(head_node)
+    head_node = pydot.Node(ref, label=ref, fillcolor='#ff3333', fontcolor='white', tooltip='Symbolic Ref: HEAD')
+    groups.add('branch', head_node, model_node(ref, 'branch', ref, 'Symbolic Ref: HEAD'))
 
     symref = repo.refs.read_ref(ref)
     if symref.startswith('ref: '):
         symref = symref[5:]
-    points_to = add_branch_node(symref)
-    graph.add_node(points_to)
-    graph.add_edge(pydot.Edge(head_node, add_branch_node(symref), **edge_opts(style='dotted')))
+    add_branch_node(groups, symref)
+    groups.add_edge(ref, symref, style='dotted')
+
+    nodes = repo_graph.builder.nodes
+    render_nodes = {} # model nodes of vertices that only live in this render
 
     # index
     if options.index:
@@ -61,171 +158,1329 @@ def emit_repo_as_xdot(repo, options):
         except KeyError:
             head_tree = None
 
-        index = repo.open_index()
+        changes = repo_graph.index_changes.get(repo, head_tree, repo_graph.builder.store)
 
-    try:
-        changes = list(index.changes_from_tree(objstore, head_tree))
-    except TypeError:
-        # the official dulwich repo throws a TypeError changes_from_tree is
-        # called against an empty tree (None)
-        if head_tree is not None: raise
-        changes = []
-
-    if changes:
-        index_node = pydot.Node('index', shape='invtriangle', style='filled', fillcolor='#33ff33', fontname=DEFAULT_FONTNAME, fontsize=DEFAULT_FONTSIZE)
-        graph.add_node(index_node)
-        for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in changes:
-            graph.add_edge(pydot.Edge(index_node, vert_for_sha(objstore, newsha), label=q('  ' + newpath), fontname=DEFAULT_FONTNAME, fontsize=DEFAULT_FONTSIZE))
+        if changes:
+            index_node = pydot.Node('index', shape='invtriangle', style='filled', fillcolor='#33ff33')
+            index_node.set('class', 'index')
+            graph.add_node(index_node)
+            groups.model.add_node(model_node('index', 'index'))
+            for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in changes:
+                if newsha is None: continue # removed from the index
+                if newsha not in nodes and newsha not in render_nodes:
+                    # not part of the walked graph (e.g. --no-blobs), so
+                    # it only lives in this render.
+                    group, vert, node = repo_graph.builder.make_vertex(newsha)
+                    if vert is None: continue
+                    groups.add(group, vert, node)
+                    render_nodes[newsha] = node
+                groups.add_edge('index', newsha, newpath)
+
+    # working tree modifications, marked on the blobs the index has for them.
+    # only the files whose blobs are drawn are looked at, which with
+    # --no-blobs is just the ones the index changed.
+    if options.worktree and repo.has_index():
+        shown = lambda sha: sha in nodes or sha in render_nodes
+        changes = repo_graph.worktree_changes.get(repo, repo_graph.index_changes, shown)
+        for sha, paths in sorted(changes.iteritems()):
+            node = nodes.get(sha) or render_nodes.get(sha)
+            opts = worktree_opts(node, paths)
+            groups.model.override(sha, opts)
+            opts['label'] = q(opts['label'])
+            graph.add_node(pydot.Node(sha, **opts))
+
+    return graph, groups.model
+
+def iter_output(graph, model, options, metrics=None):
+    '''Yields the xdot for a pydot graph in chunks, or with --format=json its
+    GraphModel as JSON, which is written out as it is serialized.'''
+
+    if metrics is None:
+        metrics = RenderMetrics()
+
+    # the client lays the model out itself, so neither DOT nor dot is needed
+    if options.format == 'json':
+        metrics.layout = 'json'
+        for chunk in metrics.timed_chunks('serialize', iter_json(model), 'json_bytes'):
+            yield chunk
+    else:
+        yield layout_graph(graph, options, metrics)
+
+def layout_graph(graph, options, metrics=None):
+    'Returns the xdot for a pydot graph.'
+
+    if metrics is None:
+        metrics = RenderMetrics()
+
+    # commit graphs can be laid out without Graphviz; trees and blobs still
+    # need dot, as does everything when numpy isn't around.
+    if options.layout == 'lanes':
+        if options.blobs:
+            warn_once('--layout=lanes needs --no-blobs, laying out with dot instead')
+        elif not lanes.available():
+            warn_once('--layout=lanes needs numpy, which is not installed; laying out with dot instead')
+        else:
+            metrics.layout = 'lanes'
+            return metrics.timed('lanes', lanes.layout, graph)
 
     # invoke dot -Txdot to turn out DOT file into an xdot file, which canviz is expecting
-    subprocess.Popen(['dot', '-Txdot'], stdin=subprocess.PIPE).communicate(graph.to_string())
+    metrics.layout = 'dot'
+    chunks = metrics.timed_chunks('serialize', graph.iter_dot(), 'dot_bytes')
+    run = lambda chunks: run_dot(chunks, metrics)
 
-def vert_for_sha(objstore, sha, **opts):
-    if isinstance(sha, pydot.Node):
-        sha = sha.sha
+    cache = get_layout_cache(options)
+    if cache is None:
+        return run(chunks)
 
-    vert = vertices.get(sha)
+    hits = cache.hits
+    output = cache.layout(chunks, run)
+    metrics.layout_cache_hit = cache.hits > hits
+    return output
 
-    try:
-        obj = objstore[sha]
-    except KeyError:
-        return None
+_warned = set()
+
+def warn_once(message):
+    'Writes a warning to stderr, only the first time it comes up in this process.'
+
+    if message not in _warned:
+        _warned.add(message)
+        sys.stderr.write('gitviz.py: warning: %s\n' % message)
+
+def iter_json(model):
+    '''Yields a GraphModel as compact JSON in chunks, one per node or edge,
+    for clients that do their own layout:
+
+        {"nodes": [{"id", "type", "label", "tooltip", "color"}, ...],
+         "edges": [{"source", "target", "label", "style"}, ...]}'''
+
+    dump = lambda item: json.dumps(item, separators=(',', ':'))
+
+    yield '{"nodes":['
+    for i, node in enumerate(model.iter_nodes()):
+        yield (',' if i else '') + dump(node)
+
+    yield '],"edges":['
+    for i, edge in enumerate(model.iter_edges()):
+        yield (',' if i else '') + dump(edge)
+
+    yield ']}\n'
+
+class GraphModel(object):
+    '''The vertices and edges of a graph as plain dicts, made from the same
+    objects as its pydot graph rather than parsed back out of it, for
+    --format=json and deltas (see model_node() and model_edge()).
+
+    Nodes and edges are kept in the order they were added, so a commit's
+    parents are in order. The GraphBuilder's nodes are shared with every
+    render, so a node that is added again (like DOT, this merges what it
+    says into the first) or marked for the working tree only changes it
+    through overrides for this render.'''
+
+    def __init__(self):
+        self.nodes = collections.OrderedDict() # id -> node
+        self.edges = []
+        self.overrides = {} # node id -> keys to change for this render
+
+    def add_node(self, node):
+        if node['id'] in self.nodes:
+            self.override(node['id'], dict((key, value) for key, value in node.iteritems()
+                                           if key not in ('id', 'type')))
+        else:
+            self.nodes[node['id']] = node
+
+    def add_edge(self, edge):
+        self.edges.append(edge)
+
+    def override(self, id, opts):
+        override = self.overrides.setdefault(model_text(id), {})
+        override.update((key, model_text(value)) for key, value in opts.iteritems())
+
+    def iter_nodes(self):
+        for id, node in self.nodes.iteritems():
+            override = self.overrides.get(id)
+            if override:
+                node = dict(node, **override)
+            yield node
+
+    def iter_edges(self):
+        return iter(self.edges)
 
-    if vert is None:
-        vertex_opts = vertex_opts_for_obj(obj)
-        vert = vertices[sha] = pydot.Node(sha, **vertex_opts)
-        vert.sha = sha
-        graph.add_node(vert)
+    def as_lists(self):
+        '''Returns (nodes, edges) as lists, which is what model_delta()
+        compares.'''
 
-    vert.obj = obj
-    return vert
+        return list(self.iter_nodes()), list(self.iter_edges())
 
-def to_sha(vert):
-    if not isinstance(vert, str):
-        return vert.obj.sha().hexdigest()
+def model_node(id, kind, label=None, tooltip=None, color=None):
+    '''Returns the model of a vertex: a dict of its id, its type (its
+    VERTEX_GROUPS kind, or "index") and whichever of label, tooltip and
+    color it has, as plain unicode text. A kind's default label is used if
+    it isn't given one.'''
 
-    return vert
+    if label is None:
+        label = VERTEX_GROUPS.get(kind, {}).get('label')
 
-def add_edge(a, b, **opts):
-    edge = pydot.Edge(to_sha(a), to_sha(b), **edge_opts(**opts))
-    graph.add_edge(edge)
+    node = dict(id=model_text(id), type=kind)
+    for key, value in (('label', label), ('tooltip', tooltip), ('color', color)):
+        if value is not None:
+            node[key] = model_text(value)
+    return node
+
+def model_edge(source, target, label=None, style=None):
+    '''Returns the model of an edge between the vertices with the given ids:
+    a dict of its source and target, and its label and style if it has them.'''
+
+    edge = dict(source=model_text(source), target=model_text(target))
+    if label is not None:
+        edge['label'] = model_text(label)
+    if style is not None:
+        edge['style'] = style
     return edge
 
-def walk_node(objstore, seen, sha, options):
-    vert = vert_for_sha(objstore, sha)
-    if vert is None or vert in seen: return
+def model_text(value):
+    'Returns text from git (names, messages, paths) as unicode.'
 
-    seen.add(vert)
-    obj = vert.obj
+    if isinstance(value, unicode):
+        return value
+    return value.decode('utf-8', 'replace')
 
-    # TODO: visitor pattern with polymorphism instead plz
-    if obj.type_name == 'tree':
-        if options.blobs:
-            for stat, filename, sha in vert.obj.entries():
-                child = vert_for_sha(objstore, sha)
-                if child is not None:
-                    add_edge(vert, child, label=q('  ' + filename))
-                    walk_node(objstore, seen, child, options)
+def model_delta(old, new):
+    '''Returns what changed from one GraphModel.as_lists() to the next, as a dict
+    with only the keys that have something in them:
 
-    elif obj.type_name == 'commit':
-        if options.blobs:
-            tree = obj.tree
-            tree_vert = vert_for_sha(objstore, obj.tree)
+        nodes_added:   new nodes
+        nodes_removed: ids of nodes that are gone
+        nodes_changed: {"id", ...} with each changed key's new value, or
+                       null for keys the node doesn't have any more
+        edges_added:   new edges
+        edges_removed: edges that are gone
+
+    An edge is the same edge only if all of its keys are the same, so a
+    changed edge is removed and added again. Edges that are the same are
+    counted, since each of them is drawn.'''
+
+    old_nodes, old_edges = old
+    new_nodes, new_edges = new
+    delta = dict(nodes_added=[], nodes_removed=[], nodes_changed=[],
+                 edges_added=[], edges_removed=[])
+
+    before = dict((node['id'], node) for node in old_nodes)
+    after = set()
+    for node in new_nodes:
+        after.add(node['id'])
+        prev = before.get(node['id'])
+        if prev is None:
+            delta['nodes_added'].append(node)
+        elif prev != node:
+            changed = dict((key, node.get(key)) for key in set(prev) | set(node)
+                           if prev.get(key) != node.get(key))
+            changed['id'] = node['id']
+            delta['nodes_changed'].append(changed)
+    delta['nodes_removed'] = [node['id'] for node in old_nodes if node['id'] not in after]
+
+    def unmatched(edges, others):
+        counts = collections.Counter(edge_key(edge) for edge in others)
+        for edge in edges:
+            key = edge_key(edge)
+            if counts[key] > 0:
+                counts[key] -= 1
+            else:
+                yield edge
+
+    edge_key = lambda edge: tuple(sorted(edge.iteritems()))
+    delta['edges_added'] = list(unmatched(new_edges, old_edges))
+    delta['edges_removed'] = list(unmatched(old_edges, new_edges))
+
+    return dict((key, value) for key, value in delta.iteritems() if value)
+
+_dot_version = None
+_layout_caches = {}
+
+def dot_version():
+    'What dot -V says about itself, so that upgrading Graphviz invalidates cached layouts.'
+
+    global _dot_version
+    if _dot_version is None:
+        proc = subprocess.Popen(['dot', '-V'], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate('')
+        _dot_version = (out + err).strip()
+    return _dot_version
+
+def get_layout_cache(options):
+    'Returns the LayoutCache for options, or None if layouts shouldn\'t be cached.'
+
+    if options.layout_cache_mb <= 0:
+        return None
+
+    key = (options.layout_cache, options.layout_cache_mb)
+    cache = _layout_caches.get(key)
+    if cache is None:
+        cache = _layout_caches[key] = layoutcache.LayoutCache(
+            options.layout_cache, dot_version(), options.layout_cache_mb * 1024 * 1024)
+    return cache
+
+def run_dot(chunks, metrics=None):
+    '''Lays out DOT text with dot -Txdot and returns the xdot.
+
+    The chunks of DOT text are written to dot as they are generated, while
+    its output is read on another thread, so the whole DOT text never has to
+    be held in memory.'''
+
+    start = time.time()
+    serialized = metrics.stages.get('serialize', 0.0) if metrics is not None else 0.0
+    proc = subprocess.Popen(['dot', '-Txdot'], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, bufsize=DOT_PIPE_BUFSIZE)
+
+    output = []
+    reader = threading.Thread(target=lambda: output.append(proc.stdout.read()))
+    reader.start()
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            proc.stdin.write(chunk)
+    except IOError:
+        # dot went away early; its exit code below says why.
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        closed = time.time()
+        reader.join()
+        proc.wait()
+
+    if metrics is not None:
+        # dot gets its input as fast as we can serialize it, so most of its
+        # time shows up in the serialize stage; what's left is after stdin closes.
+        serialized = metrics.stages.get('serialize', 0.0) - serialized
+        metrics.stages['dot'] = time.time() - start - serialized
+        metrics.dot_exit_seconds = time.time() - closed
+        metrics.dot_returncode = proc.returncode
+
+    if proc.returncode != 0:
+        raise RenderError('dot: non-zero return code %d' % proc.returncode)
+
+    return output[0]
+
+class RenderError(Exception):
+    pass
+
+class ArgumentError(RenderError):
+    'Bad options in a render request.'
+
+class RenderMetrics(object):
+    '''Where the time went in one render, and how much work it did.
+
+    Stages are walk (reading and walking new objects), graph (adding refs,
+    HEAD and the index), and then either lanes, or serialize (generating DOT
+    text) and dot (waiting on dot, past what serialize already overlapped),
+    or with --format=json just serialize (generating the JSON).'''
+
+    def __init__(self):
+        self.start = time.time()
+        self.total_seconds = None
+        self.stages = {}
+        self.objects_read = {}
+        self.bytes_inflated = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.nodes = 0
+        self.edges = 0
+        self.layout = None
+        self.layout_cache_hit = None
+        self.dot_bytes = None  # DOT text handed to dot or the layout cache
+        self.json_bytes = None # JSON written with --format=json
+        self.dot_exit_seconds = None
+        self.dot_returncode = None
+
+    def timed(self, stage, func, *args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.time() - start
+
+    def timed_chunks(self, stage, chunks, count):
+        '''Passes chunks of text through, timing how long they take to make
+        and counting their bytes in the attribute named count.'''
+
+        total = 0
+        setattr(self, count, total)
+        chunks = iter(chunks)
+        while True:
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.stages[stage] = self.stages.get(stage, 0.0) + time.time() - start
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            total += len(chunk)
+            setattr(self, count, total)
+            yield chunk
+
+    def count_reads(self, before, after):
+        for type_name, count in after['objects_read'].iteritems():
+            count -= before['objects_read'].get(type_name, 0)
+            if count:
+                self.objects_read[type_name] = count
+        self.bytes_inflated = after['bytes_inflated'] - before['bytes_inflated']
+        self.cache_hits = after['cache_hits'] - before['cache_hits']
+        self.cache_misses = after['cache_misses'] - before['cache_misses']
+
+    def count_graph(self, graph):
+        self.nodes = self.edges = 0
+        pending = [graph.obj_dict]
+        while pending: # vertices are in subgraphs, see VertexGroups
+            obj_dict = pending.pop()
+            nodes = obj_dict['nodes']
+            self.nodes += sum(len(nodes[name]) for name in nodes if name not in ('node', 'edge', 'graph'))
+            self.edges += sum(len(edges) for edges in obj_dict['edges'].itervalues())
+            for sgraphs in obj_dict['subgraphs'].itervalues():
+                pending.extend(sgraphs)
+
+    def finish(self):
+        self.total_seconds = time.time() - self.start
+
+    def as_dict(self):
+        d = dict(self.__dict__)
+        del d['start']
+        return d
+
+def builder_stats(builder):
+    'The running totals from a GraphBuilder that RenderMetrics reports the change in.'
+
+    if builder is None:
+        return dict(objects_read={}, bytes_inflated=0, cache_hits=0, cache_misses=0)
+
+    return dict(
+        objects_read=dict(builder.reader.objects_read),
+        bytes_inflated=builder.reader.bytes_inflated,
+        cache_hits=builder.cache.hits,
+        cache_misses=builder.cache.misses,
+    )
+
+def write_metrics(metrics, path):
+    'Appends metrics as a line of JSON to the file at path, or to stderr if path is "-".'
+
+    line = json.dumps(metrics.as_dict(), sort_keys=True) + '\n'
+    if path == '-':
+        sys.stderr.write(line)
+        return
+
+    f = open(path, 'a')
+    try:
+        f.write(line)
+    finally:
+        f.close()
+
+class GraphBuilder(object):
+    '''Turns git objects into pydot vertices and edges.
+
+    Vertices and edges are remembered in the order they were made, so that
+    they can be added to a fresh pydot graph for each render without walking
+    their objects again.'''
+
+    def __init__(self, objstore, options, reader=None, cache=None):
+        '''Pass an ObjectReader and ObjectCache to share them with other
+        builders for the same object store; otherwise the builder has its own.'''
+
+        self.objstore = objstore
+        self.owns_reader = reader is None
+        if reader is None:
+            reader = gitstore.ObjectReader(objstore)
+        if cache is None:
+            cache = gitstore.ObjectCache(options.object_cache_mb * 1024 * 1024)
+        self.reader = reader
+        self.cache = cache
+        self.store = gitstore.CachedObjectStore(objstore, self.cache, self.read_object)
+        self.options = options
+        self.clear()
+
+    def clear(self):
+        'Forgets everything walked so far, but keeps the objects cached.'
+
+        self.vertices = {}
+        self.nodes = {} # sha -> model_node() of its vertex
+        self.elements = [] # (kind or None for an edge, pydot element, its model)
+        self.decoded = {} # sha -> object decoded ahead of a walk, see decode()
+        self.seen = set()
+        self.window = None # shas of the commits to show, if not all of them
+        self.tree_bases = {} # tree sha -> sha of the tree to only draw its changes from
+
+    def close(self):
+        if self.owns_reader:
+            self.reader.close()
+
+    def add_to_graph(self, groups):
+        'Adds everything walked so far to the graph of a VertexGroups.'
+
+        for group, element, item in self.elements:
+            if group is None:
+                groups.graph.add_edge(element)
+                groups.model.add_edge(item)
+            else:
+                groups.add(group, element, item)
+
+    def get_object(self, sha):
+        '''Returns the object with the given sha, or None if it is missing.
+        Blobs come back as a gitstore.BlobPrefix with just enough of their
+        content for a label.'''
+
+        obj = self.decoded.get(sha)
+        if obj is not None:
+            return obj
+
+        try:
+            return self.cache.get(sha, self.read_object)
+        except KeyError:
+            return None
+
+    def read_object(self, sha):
+        return self.reader.read(sha, BLOB_CONTENT_LIMIT)
+
+    def decode(self, shas):
+        '''Decodes the objects with the given shas in a pool of options.jobs
+        processes, ahead of walking them, if there are enough of them to be
+        worth it. The walk then only has to assemble the graph.
+
+        Commits and trees come back as gitstore summaries with just what the
+        walk uses. Anything else, and anything the walk reaches that wasn't
+        decoded here, is read in this process as usual.
+
+        Only reading and parsing is spread out: the pydot vertices and edges
+        are still made one at a time here, and that takes about as long as
+        the decoding did, so the walk gets at most about twice as fast
+        however many processes there are.'''
+
+        jobs = self.options.jobs
+        if jobs == 0:
+            jobs = multiprocessing.cpu_count()
+        if jobs < 2: return
+
+        shas = [sha for sha in shas if sha not in self.cache]
+        if len(shas) < PARALLEL_DECODE_MIN: return
+
+        self.decoded = gitstore.decode_objects(self.reader, shas, BLOB_CONTENT_LIMIT, jobs)
+
+    def make_vertex(self, sha, obj=None):
+        '''Returns (group, vertex, node) for the object with the given sha: the
+        VERTEX_GROUPS kind it belongs to, a new pydot vertex and its
+        model_node(), or (None, None, None) if the object is missing.'''
+
+        if obj is None:
+            obj = self.get_object(sha)
+            if obj is None:
+                return None, None, None
+
+        group = vertex_group(obj)
+        label, tooltip = vertex_text(obj)
+        return (group, pydot.Node(sha, **vertex_opts(label, tooltip)),
+                model_node(sha, group, label, tooltip))
+
+    def vert_for_sha(self, sha, obj=None):
+        vert = self.vertices.get(sha)
+        if vert is None:
+            group, vert, node = self.make_vertex(sha, obj)
+            if vert is not None:
+                self.vertices[sha] = vert
+                self.nodes[sha] = node
+                self.elements.append((group, vert, node))
+
+        return vert
+
+    def boundary_vert_for_sha(self, sha):
+        'Returns a marker vertex for a commit just outside the window.'
+
+        vert = self.vertices.get(sha)
+        if vert is None:
+            opts = boundary_opts(sha)
+            vert = self.vertices[sha] = pydot.Node(sha, **opts)
+            node = self.nodes[sha] = model_node(sha, 'boundary', **opts)
+            self.elements.append(('boundary', vert, node))
+
+        return vert
+
+    def add_edge(self, a, b, label=None, style=None, **opts):
+        '''Adds an edge from the vertex for sha a to the one for sha b. The
+        label is plain text, and opts are only for pydot.'''
+
+        if label is not None:
+            opts['label'] = q('  ' + label)
+        if style is not None:
+            opts['style'] = style
+        edge = pydot.Edge(a, b, **opts)
+        self.elements.append((None, edge, model_edge(a, b, label, style)))
+        return edge
+
+    def peel(self, sha):
+        'Follows tags to the object they point at, and returns its sha.'
+
+        obj = self.get_object(sha)
+        while obj is not None and obj.type_name == 'tag':
+            sha = obj.object[1]
+            obj = self.get_object(sha)
+
+        return sha
+
+    def select_window(self, tips, hidden=(), max_commits=None, since=None):
+        '''Returns the shas of the commits to show, newest first.
+
+        Like git log, commits are taken from a priority queue ordered by
+        commit date, starting with the commits in tips and leaving out any
+        that can be reached from hidden. The walk stops after max_commits
+        commits, and doesn't go past commits made before since (a unix
+        timestamp), so only a little more than the window is ever read.'''
+
+        queue = []
+        queued = set()
+        waiting = set() # shas in the queue
+        uninteresting = set()
+        interesting = [0] # how many shas in the queue aren't uninteresting
+        window = []
+
+        def push(sha, hide):
+            if hide and sha not in uninteresting:
+                uninteresting.add(sha)
+                if sha in waiting:
+                    interesting[0] -= 1
+            if sha in queued: return
+            obj = self.get_object(sha)
+            if obj is None or obj.type_name != 'commit': return
+            queued.add(sha)
+            waiting.add(sha)
+            if sha not in uninteresting:
+                interesting[0] += 1
+            heapq.heappush(queue, (-obj.commit_time, sha))
+
+        for sha in hidden:
+            push(self.peel(sha), True)
+        for sha in tips:
+            push(self.peel(sha), False)
+
+        # once everything left is hidden, nothing more can be shown
+        while interesting[0]:
+            commit_time, sha = heapq.heappop(queue)
+            waiting.remove(sha)
+            hide = sha in uninteresting
+            if not hide:
+                interesting[0] -= 1
+                if since is not None and -commit_time < since: continue
+                if max_commits is not None and len(window) >= max_commits: break
+                window.append(sha)
+
+            for parent_sha in self.get_object(sha).parents:
+                push(parent_sha, hide)
+
+        return window
+
+    def walk(self, shas):
+        '''Walks the objects with the given shas and everything reachable from them.
+
+        The walk uses an explicit stack (or queue, for options.walk_order ==
+        'bfs') instead of recursion, so long histories don't run into
+        Python's recursion limit. Each object is handed to the visit_<type>
+        method for its type, which adds its edges and returns the shas of the
+        objects to walk next.'''
+
+        bfs = getattr(self.options, 'walk_order', 'dfs') == 'bfs'
+        if bfs:
+            pending = collections.deque(shas)
+            next_sha = pending.popleft
+        else:
+            pending = list(reversed(shas))
+            next_sha = pending.pop
+
+        while pending:
+            sha = next_sha()
+            if sha in self.seen: continue
+
+            obj = self.get_object(sha)
+            if obj is None: continue
+
+            self.seen.add(sha)
+            vert = self.vert_for_sha(sha, obj)
+
+            visit = getattr(self, 'visit_' + obj.type_name, None)
+            if visit is None: continue
+
+            children = visit(obj, vert)
+            if bfs:
+                pending.extend(children)
+            else:
+                # push in reverse so that the first child is walked first
+                pending.extend(reversed(children))
+
+    def visit_commit(self, obj, vert):
+        children = []
+
+        if self.options.blobs:
+            tree_vert = self.vert_for_sha(obj.tree)
             if tree_vert is not None:
-                walk_node(objstore, seen, tree, options)
-                seen.add(tree_vert)
-                add_edge(vert, tree_vert, weight='1')
+                self.add_edge(obj.id, obj.tree, weight='1')
+                children.append(obj.tree)
+                if self.options.collapse_unchanged and obj.parents and obj.tree not in self.seen:
+                    self.set_tree_base(obj.tree, obj.parents[0])
 
         num_parents=len(obj.parents)
         for i, parent_sha in enumerate(obj.parents):
-            parent_vert = vert_for_sha(objstore, parent_sha)
             weight = num_parents - i + 1
-            add_edge(vert, parent_vert, weight='%s' % weight)
-            walk_node(objstore, seen, parent_sha, options)
-
-def add_branch_node(ref):
-    nopts = node_opts(
-        label=nice_ref_label(ref),
-        shape='diamond',
-        style='filled',
-        tooltip='Branch: %s' % nice_ref_label(ref))
-
-    node = pydot.Node(ref, **nopts)
-    graph.add_node(node)
-    return node
+            if self.window is not None and parent_sha not in self.window:
+                self.boundary_vert_for_sha(parent_sha)
+                self.add_edge(obj.id, parent_sha, weight='%s' % weight, style='dashed')
+                continue
+            parent_vert = self.vert_for_sha(parent_sha)
+            if parent_vert is None: continue
+            self.add_edge(obj.id, parent_sha, weight='%s' % weight)
+            children.append(parent_sha)
 
-def node_opts(**opts):
-    'Display options for vertices.'
+        return children
 
-    opts.update(DEFAULT_FONT)
-    return opts
+    def visit_tree(self, obj, vert):
+        children = []
+        if not self.options.blobs:
+            return children
 
-def edge_opts(**opts):
-    'Display options for edges.'
+        base_sha = self.tree_bases.pop(obj.id, None)
+        base = self.get_object(base_sha) if base_sha is not None else None
+        if base is None:
+            for mode, filename, child_sha in obj.entries():
+                child = self.vert_for_sha(child_sha)
+                if child is not None:
+                    self.add_edge(obj.id, child_sha, label=filename)
+                    children.append(child_sha)
+            return children
 
-    opts.update(labelfontsize='11', labelfloat="False", **DEFAULT_FONT)
-    return opts
+        # only draw what changed since the base tree, and one edge to it for the rest
+        base_entries = dict((filename, (mode, sha)) for mode, filename, sha in base.entries())
+        unchanged = 0
+        for mode, filename, child_sha in obj.entries():
+            base_entry = base_entries.pop(filename, None)
+            if base_entry == (mode, child_sha):
+                unchanged += 1
+                continue
+            child = self.vert_for_sha(child_sha)
+            if child is None: continue
+            self.add_edge(obj.id, child_sha, label=filename)
+            children.append(child_sha)
+            if (base_entry is not None and stat.S_ISDIR(mode) and stat.S_ISDIR(base_entry[0])
+                    and child_sha not in self.seen):
+                self.tree_bases[child_sha] = base_entry[1]
+
+        removed = len(base_entries)
+        if unchanged or removed:
+            label = '%d unchanged' % unchanged
+            if removed:
+                label += ', %d removed' % removed
+            # not walked from here: it's the parent commit's to walk, after
+            # giving it a base of its own.
+            base_vert = self.vert_for_sha(base_sha)
+            if base_vert is not None:
+                self.add_edge(obj.id, base_sha, label=label, style='dashed')
+
+        return children
+
+    def set_tree_base(self, tree_sha, parent_sha):
+        '''With --collapse-unchanged, has a commit's tree only drawn as what
+        changed since the tree of the parent commit with the given sha.'''
+
+        if self.window is not None and parent_sha not in self.window:
+            return # the parent's tree won't be drawn
+        parent = self.get_object(parent_sha)
+        if parent is not None and parent.type_name == 'commit' and parent.tree != tree_sha:
+            self.tree_bases[tree_sha] = parent.tree
+
+    def visit_blob(self, obj, vert):
+        return ()
+
+    def visit_tag(self, obj, vert):
+        # refs to a tag are drawn on what it peels to (see build_graph), so
+        # this edge is what ties the tag object itself into the graph.
+        target_class, target_sha = obj.object
+        if target_class.type_name in ('tree', 'blob') and not self.options.blobs:
+            return []
+        if self.vert_for_sha(target_sha) is None:
+            return []
+        self.add_edge(obj.id, target_sha, style='dotted')
+        return [target_sha]
+
+class RepoGraph(object):
+    '''The walked object graph of one repository, kept up to date incrementally.
+
+    Each update() only walks objects that showed up since the last one: loose
+    objects in fan-out directories whose mtime changed, and objects in pack
+    files we haven't seen before. Refs, HEAD and the index are cheap and are
+    redone on every render, so they aren't tracked here.
+
+    If objects went away (a pack was removed, or loose objects were pruned
+    rather than packed), everything is walked again from scratch.
+
+    Windowed views (see windowed()) don't scan the object store at all.
+    They walk back from the refs on every update instead, which stays cheap
+    because the walk stops at the edge of the window.'''
+
+    def __init__(self, repo, options, reader=None, cache=None):
+        self.repo = repo
+        self.options = options
+        self.reader = reader # shared with other RepoGraphs, if given (see GraphBuilder)
+        self.cache = cache
+        self.builder = None
+        self.index_changes = IndexChanges()
+        self.worktree_changes = WorktreeChanges()
+        self.model = None   # GraphModel.as_lists() of the last render, for deltas (see RenderServer)
+        self.version = None # what RenderServer called that render
+
+    def reset(self):
+        self.close()
+        self.builder = GraphBuilder(self.repo.object_store, self.options, self.reader, self.cache)
+        self.loose_dirs = {}  # fan-out dir name -> (mtime, set of shas)
+        self.pack_names = set()
+        self.last_scan_start = None
+
+    def close(self):
+        if self.builder is not None:
+            self.builder.close()
+
+    def update(self):
+        '''Walks new objects in the repository, and returns how many there were.'''
+
+        if windowed(self.options):
+            return self.update_window()
+
+        if self.builder is None:
+            self.reset()
+            new_objects = self.scan(first=True)
+        else:
+            new_objects = self.scan()
+            if new_objects is None:
+                self.reset()
+                new_objects = self.scan(first=True)
+
+        # walk everything in the object store. (this means orphaned nodes will show.)
+        if self.options.blobs and not self.options.collapse_unchanged:
+            new_shas = [sha for sha, type_name in new_objects]
+        else:
+            # types come from object headers, so blobs and trees are skipped
+            # without ever being inflated. with --collapse-unchanged, they
+            # are walked from the commits they changed in instead.
+            new_shas = []
+            for sha, type_name in new_objects:
+                if type_name is None:
+                    obj = self.builder.get_object(sha)
+                    if obj is None: continue
+                    type_name = obj.type_name
+                if type_name not in ('blob', 'tree'):
+                    new_shas.append(sha)
+
+        self.builder.decode(new_shas)
+        try:
+            self.builder.walk(new_shas)
+        finally:
+            self.builder.decoded = {}
+
+        return len(new_objects)
+
+    def update_window(self):
+        '''Walks the commits in the window from scratch (reusing cached objects),
+        and returns how many there were.'''
+
+        if self.builder is None:
+            self.reset()
+        builder = self.builder
+        builder.clear()
+
+        refs = select_refs(self.repo, self.options)
+        hidden = []
+        if self.options.range is not None:
+            if '..' in self.options.range:
+                start, end = self.options.range.split('..', 1)
+                hidden.append(resolve_rev(self.repo, start or 'HEAD'))
+                tips = [resolve_rev(self.repo, end or 'HEAD')]
+            else:
+                tips = [resolve_rev(self.repo, self.options.range)]
+        else:
+            tips = [sha for ref, (sha, peeled) in sorted(refs.iteritems())]
+            try:
+                tips.append(self.repo.refs['HEAD'])
+            except KeyError:
+                pass # HEAD is a dangling symbolic ref, as in a new repository
+
+        since = None
+        if self.options.since is not None:
+            since = parse_date(self.options.since)
+
+        window = builder.select_window(tips, hidden, self.options.max_commits, since)
+        builder.window = set(window)
+
+        # tags are drawn on the commits they peel to (see build_graph), so
+        # tag objects themselves aren't walked.
+        builder.walk(window)
+        return len(window)
+
+    def scan(self, first=False):
+        '''Returns a list of (sha, type_name) for the objects added to the
+        object store since the last scan, or None if objects were removed.
+
+        type_name is only filled in when blobs and trees are only reached
+        through commits (see update()), and may be
+        None if it can't be read from the object's header.'''
+
+        objstore = self.repo.object_store
+        want_types = not self.options.blobs or self.options.collapse_unchanged
+        new_objects = []
+        vanished = []
+
+        # like git's racy index entries: a directory whose mtime isn't older
+        # than the last scan may have changed again within the same tick
+        # after it was listed, so it's listed again. mtimes may only have
+        # whole seconds, so compare with the second the scan started in.
+        start = time.time()
+        racy_since = int(self.last_scan_start) if self.last_scan_start is not None else None
+        self.last_scan_start = start
+
+        # loose objects
+        for dirname in os.listdir(objstore.path):
+            if len(dirname) != 2: continue
+            path = os.path.join(objstore.path, dirname)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            last_mtime, last_shas = self.loose_dirs.get(dirname, (None, set()))
+            if mtime == last_mtime and mtime < racy_since: continue
+
+            shas = set(dirname + f for f in os.listdir(path) if len(f) == 38)
+            for sha in shas - last_shas:
+                type_name = None
+                if want_types:
+                    try:
+                        type_name = gitstore.loose_object_header(os.path.join(path, sha[2:]))[0]
+                    except (IOError, ValueError, zlib.error):
+                        pass
+                new_objects.append((sha, type_name))
+            vanished.extend(last_shas - shas)
+            self.loose_dirs[dirname] = (mtime, shas)
+
+        for dirname in set(self.loose_dirs) - set(os.listdir(objstore.path)):
+            vanished.extend(self.loose_dirs.pop(dirname)[1])
+
+        # packs
+        pack_names = set(f[:-len('.idx')] for f in os.listdir(objstore.pack_dir) if f.endswith('.idx'))
+        if self.pack_names - pack_names:
+            return None
+        for name in pack_names - self.pack_names:
+            basename = os.path.join(objstore.pack_dir, name)
+            if want_types:
+                headers = gitstore.PackHeaders(basename)
+                try:
+                    new_objects.extend(headers.iter_types())
+                finally:
+                    headers.close()
+            else:
+                index = dulwich.pack.load_pack_index(basename + '.idx')
+                try:
+                    new_objects.extend((sha, None) for sha in index)
+                finally:
+                    index.close()
+        self.pack_names = pack_names
+
+        # loose objects usually vanish because they were packed, which is fine.
+        for sha in vanished:
+            if sha not in objstore:
+                return None
+
+        if first:
+            for alternate in objstore.alternates:
+                new_objects.extend((sha, None) for sha in alternate)
+
+        return new_objects
+
+class IndexChanges(object):
+    '''The differences between a repository's index and its HEAD tree, in the
+    form Index.changes_from_tree gives them, kept up to date between renders.
+
+    Nothing is looked at again while the index file's stat and the HEAD tree
+    stay the same. When the index file changes it is read again, but only the
+    entries whose sha or mode changed are compared with HEAD. When HEAD's tree
+    changes, the old and new trees are diffed without reading the subtrees
+    they share, and only the paths that differ are compared.
+
+    The entries' stat data is kept too, for WorktreeChanges.'''
+
+    def __init__(self):
+        self.index_stat = None
+        self.index_entries = None # path -> (sha, mode), None until the index is read
+        self.index_stats = {} # path -> (mtime, size, inode) recorded in the index
+        self.tree = None
+        self.tree_entries = {} # path -> (sha, mode) of the blobs in self.tree
+        self.changes = {} # path -> change, for the paths that differ
+        self.pending = set() # paths to compare again
+
+    def get(self, repo, head_tree, store):
+        '''Returns the list of ((oldpath, newpath), (oldmode, newmode), (oldsha,
+        newsha)) changes from head_tree (a sha, or None) to the index, sorted
+        by path. Trees are read from store.'''
+
+        if head_tree != self.tree:
+            self.pending.update(self.diff_trees(store, self.tree, head_tree))
+            self.tree = head_tree
+
+        self.read(repo)
+
+        for path in self.pending:
+            self.compare(path)
+        self.pending.clear()
+
+        return [self.changes[path] for path in sorted(self.changes)]
+
+    def read(self, repo):
+        'Reads the index again if its file changed since the last time.'
+
+        index_stat = file_stat(repo.index_path())
+        if self.index_entries is not None and index_stat == self.index_stat: return
+
+        old_entries = self.index_entries or {}
+        self.index_entries = {}
+        self.index_stats = {}
+        self.index_stat = index_stat
+
+        if index_stat is not None:
+            index = repo.open_index()
+            for path in index:
+                entry = index[path]
+                # sha and mode, as changes_from_tree compares them
+                self.index_entries[path] = (entry[-2], entry[-6])
+                mtime = entry[1]
+                if isinstance(mtime, tuple):
+                    mtime = mtime[0] # (seconds, nanoseconds)
+                self.index_stats[path] = (mtime, entry[7], entry[3])
+
+        for path, entry in self.index_entries.iteritems():
+            if old_entries.get(path) != entry:
+                self.pending.add(path)
+        self.pending.update(path for path in old_entries if path not in self.index_entries)
+
+    def compare(self, path):
+        old = self.tree_entries.get(path)
+        new = self.index_entries.get(path)
+
+        if old == new:
+            self.changes.pop(path, None)
+        elif new is None:
+            self.changes[path] = ((path, None), (old[1], None), (old[0], None))
+        elif old is None:
+            self.changes[path] = ((None, path), (None, new[1]), (None, new[0]))
+        else:
+            self.changes[path] = ((path, path), (old[1], new[1]), (old[0], new[0]))
+
+    def diff_trees(self, store, old_tree, new_tree):
+        '''Brings tree_entries from old_tree to new_tree (either may be None),
+        and returns the paths of the blobs that changed.'''
+
+        def items(tree):
+            if tree is None:
+                return {}
+            return dict((name, (sha, mode)) for mode, name, sha in store[tree].entries())
+
+        changed = []
+        pending = [('', old_tree, new_tree)]
+        while pending:
+            prefix, old_tree, new_tree = pending.pop()
+            old_items, new_items = items(old_tree), items(new_tree)
+
+            for name in set(old_items) | set(new_items):
+                old, new = old_items.get(name), new_items.get(name)
+                if old == new: continue
+
+                path = prefix + name
+                old_subtree = new_subtree = None
+                if old is not None:
+                    if stat.S_ISDIR(old[1]):
+                        old_subtree = old[0]
+                    else:
+                        del self.tree_entries[path]
+                        changed.append(path)
+                if new is not None:
+                    if stat.S_ISDIR(new[1]):
+                        new_subtree = new[0]
+                    else:
+                        self.tree_entries[path] = new
+                        changed.append(path)
+
+                if old_subtree is not None or new_subtree is not None:
+                    pending.append((path + '/', old_subtree, new_subtree))
+
+        return changed
+
+class WorktreeChanges(object):
+    '''Finds the files in a repository's working tree that differ from the
+    index, cheaply enough to run on every render.
+
+    Each file is lstat'ed and compared with the mtime, size and inode the
+    index recorded for it. Only files whose stat doesn't match (or that were
+    changed too soon after the index was written to tell) are read and
+    hashed, and each hash is remembered until the file's stat changes again.
+    Content filters like core.autocrlf aren't applied.'''
+
+    def __init__(self):
+        self.hashed = {} # path -> (stat, blob sha) of the last file hashed
+
+    def get(self, repo, index, shown=None):
+        '''Returns {blob sha in the index: [(path, 'modified' or 'deleted')]}
+        for the working tree files that differ from an IndexChanges' index.
+
+        Pass shown, a function of a blob sha, to only look at the files
+        whose blobs it is true for.'''
+
+        index.read(repo)
+        root = repo.path
+        index_mtime = index.index_stat and int(index.index_stat[0])
+        changes = {}
+
+        for path, (sha, mode) in index.index_entries.iteritems():
+            if stat.S_ISDIR(mode) or stat.S_IFMT(mode) == 0160000: continue # gitlinks
+            if shown is not None and not shown(sha): continue
+
+            try:
+                st = os.lstat(os.path.join(root, path))
+            except OSError:
+                changes.setdefault(sha, []).append((path, 'deleted'))
+                continue
+
+            mtime, size, ino = index.index_stats[path]
+            if (int(st.st_mtime) == mtime and st.st_size & 0xffffffff == size
+                    and st.st_ino & 0xffffffff == ino and mtime < index_mtime):
+                continue
+
+            if self.hash_file(path, os.path.join(root, path), st) != sha:
+                changes.setdefault(sha, []).append((path, 'modified'))
+
+        for path in set(self.hashed) - set(index.index_entries):
+            del self.hashed[path]
+
+        return changes
+
+    def hash_file(self, path, full_path, st):
+        key = (st.st_mtime, st.st_size, st.st_ino, st.st_mode)
+        last = self.hashed.get(path)
+        if last is not None and last[0] == key:
+            return last[1]
+
+        try:
+            if stat.S_ISLNK(st.st_mode):
+                data = os.readlink(full_path)
+            else:
+                f = open(full_path, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+        except (IOError, OSError):
+            return None # changed under us; it counts as modified until next time
+
+        sha = dulwich.objects.Blob.from_string(data).id
+        self.hashed[path] = (key, sha)
+        return sha
+
+def windowed(options):
+    'Returns True if options only ask for part of the history.'
+
+    return (options.max_commits is not None or options.since is not None
+            or options.range is not None)
+
+def select_refs(repo, options):
+    '''Returns {name: (sha, peeled)} for the refs to show, leaving out HEAD: the
+    ones that match one of options.refs, if any are given, and none of
+    options.exclude_refs. See gitstore.read_refs.'''
+
+    refs = gitstore.read_refs(repo.controldir())
+
+    def matches(name, patterns):
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    if options.refs:
+        refs = dict((name, value) for name, value in refs.iteritems() if matches(name, options.refs))
+    if options.exclude_refs:
+        refs = dict((name, value) for name, value in refs.iteritems() if not matches(name, options.exclude_refs))
+
+    return refs
+
+def resolve_rev(repo, name):
+    'Returns the sha of a ref name, a short ref name like a branch or tag, or a full sha.'
+
+    for ref in (name, 'refs/' + name, 'refs/tags/' + name, 'refs/heads/' + name, 'refs/remotes/' + name):
+        try:
+            return repo.refs[ref]
+        except KeyError:
+            pass
+
+    if len(name) == 40 and name in repo.object_store:
+        return name
+
+    raise RenderError('unknown revision: %s' % name)
+
+def parse_date(s):
+    '''Returns a unix timestamp for a date given as seconds since the epoch,
+    or as YYYY-MM-DD with an optional HH:MM[:SS], in local time.'''
+
+    if s.isdigit():
+        return int(s)
+
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(time.strptime(s, fmt)))
+        except ValueError:
+            pass
+
+    raise RenderError('bad date: %s' % s)
+
+class VertexGroups(object):
+    '''Adds vertices to a graph, each inside the anonymous subgraph for its
+    kind in VERTEX_GROUPS, and their model_node()s to its GraphModel.
+
+    A kind's subgraph is added the first time one of its vertices is, which
+    is before any edge can mention that vertex, so dot (and lanes) always
+    create the vertex with its kind's defaults.'''
+
+    def __init__(self, graph, model):
+        self.graph = graph
+        self.model = model
+        self.subgraphs = {}
+
+    def add(self, group, vert, node):
+        sgraph = self.subgraphs.get(group)
+        if sgraph is None:
+            sgraph = self.subgraphs[group] = pydot.Subgraph()
+            defaults = dict(VERTEX_GROUPS[group])
+            defaults['class'] = group # names the kind in SVG output
+            sgraph.set_node_defaults(**defaults)
+            self.graph.add_subgraph(sgraph)
+
+        sgraph.add_node(vert)
+        self.model.add_node(node)
+
+    def add_edge(self, a, b, label=None, style=None):
+        '''Adds an edge from the vertex named a to the one named b, with a
+        plain text label.'''
+
+        opts = dict(style=style) if style is not None else {}
+        if label is not None:
+            opts['label'] = q('  ' + label)
+        self.graph.add_edge(pydot.Edge(a, b, **opts))
+        self.model.add_edge(model_edge(a, b, label, style))
+
+def add_branch_node(groups, ref):
+    label = nice_ref_label(ref)
+    tooltip = 'Branch: %s' % label
+    groups.add('branch', pydot.Node(ref, label=q(label), tooltip=tooltip),
+               model_node(ref, 'branch', label, tooltip))
+    return ref
 
 def q(s):
-    '''pydot seems to not be quoting colons in labels, even though not doing
-    so apparently results in invalid DOT files. quote them here.'''
+    '''Returns plain text as a quoted DOT string, for a label.
 
-    return s.replace(':', r'\:')
+    pydot seems to not be quoting colons in labels, even though not doing
+    so apparently results in invalid DOT files, and it passes text that
+    looks like an HTML label or a quoted string through as it is. quote
+    everything here.'''
+
+    for a, b in (('"', r'\"'), ('\n', r'\n'), ('\r', r'\r'), (':', r'\:')):
+        s = s.replace(a, b)
+    return '"' + s + '"'
 
 def get_blob_content(obj):
     "Return the first part of a blob's content for its the label."
 
-    blob_content = str(obj).decode('ascii', 'ignore') # TODO: does utf8 just work?
-    blob_content = blob_content.replace('\0', '').replace('\n', '\\n')
+    if obj.is_binary():
+        return '[binary, %d bytes]' % obj.size
+
+    blob_content = obj.data.decode('ascii', 'ignore') # TODO: does utf8 just work?
+    blob_content = blob_content.replace('\0', '')
     return blob_content[:BLOB_CONTENT_LIMIT]
 
-def vertex_opts_for_obj(obj, **opts):
-    'Return pydot display options for a git repository object.'
+def vertex_group(obj):
+    'Returns the VERTEX_GROUPS kind for a git repository object.'
+
+    if obj.type_name in ('commit', 'tree', 'blob'):
+        return obj.type_name
+    return 'other'
 
-    opts = node_opts(**opts)
+def vertex_text(obj):
+    '''Return (label, tooltip) for a git repository object as plain text,
+    with None for either one that its VERTEX_GROUPS entry decides.'''
 
-    def shortsha():
-        return q(obj.sha().hexdigest()[:20])
+    shortsha = obj.id[:20]
 
     if obj.type_name == 'commit':
-        opts.update(
-            label=q(obj.message),
-            style='filled',
-            shape='note',
-            fillcolor='#ccffcc',
-            tooltip='Commit: ' + shortsha()
-        )
+        return obj.message.strip(), 'Commit: ' + shortsha
     elif obj.type_name == 'tree':
-        opts.update(
-            shape='folder',
-            label='tree',
-            fontcolor='#a0a0a0',
-            style='filled',
-            fillcolor='#ffffff',
-            tooltip='Tree: ' + shortsha()
-        )
+        return None, 'Tree: ' + shortsha
     elif obj.type_name == 'blob':
-        label = q(get_blob_content(obj))
-        opts.update(
-            style='filled',
-            fillcolor='#ffffff',
-            shape='ellipse',
-            label=label,
-            tooltip='Blob: ' + shortsha()
-        )
+        return get_blob_content(obj).strip(), 'Blob: ' + shortsha
     else:
-        opts.update(
-            shape='ellipse',
-            label=q(repr(obj)),
-            style='filled',
-            fillcolor='#ffffff'
-        )
+        return repr(obj).strip(), None
 
-    if 'label' in opts:
-        opts['label'] = opts['label'].strip()
+def vertex_opts(label, tooltip):
+    '''Return pydot display options for a vertex's vertex_text(), leaving
+    out the ones in its VERTEX_GROUPS entry.'''
 
+    opts = {}
+    if label is not None:
+        opts['label'] = q(label)
+    if tooltip is not None:
+        opts['tooltip'] = tooltip
     return opts
 
+def worktree_opts(node, paths):
+    '''Return display options, as plain text, that mark the model_node() of
+    a blob as differing from the working tree at the given (path,
+    'modified' or 'deleted') pairs. They're written in a second statement
+    for the vertex, which dot merges into the first, so the vertex itself
+    is left alone.'''
+
+    descriptions = ['%s %s' % (state, path) for path, state in sorted(paths)]
+
+    return dict(
+        label=(node.get('label') or '') + ' *',
+        color=WORKTREE_COLOR,
+        tooltip='%s (%s in the working tree)' % (node.get('tooltip') or '', ', '.join(descriptions))
+    )
+
+def boundary_opts(sha):
+    '''Return display options for a commit at the edge of the window,
+    leaving out the ones in VERTEX_GROUPS['boundary'].'''
+
+    return dict(
+        tooltip='Boundary: %s (older history not shown)' % sha[:20]
+    )
+
+def add_refs_node(groups, sha, refs):
+    '''Adds one node for all the refs other than branches that point at sha,
+    listing up to REF_LABEL_LIMIT of them, and returns its name.'''
+
+    if len(refs) == 1:
+        return add_branch_node(groups, refs[0])
+
+    labels = [nice_ref_label(ref) for ref in refs]
+    if len(labels) > REF_LABEL_LIMIT:
+        labels[REF_LABEL_LIMIT - 1:] = ['(%d more)' % (len(labels) - REF_LABEL_LIMIT + 1)]
+
+    name = 'refs@' + sha
+    label = '\n'.join(labels)
+    tooltip = 'Refs: %s' % ', '.join(labels)
+    groups.add('branch', pydot.Node(name, label=q(label), tooltip=tooltip),
+               model_node(name, 'branch', label, tooltip))
+    return name
+
 def nice_ref_label(ref):
     'Formats a ref to be more readable for the graph.'
 
@@ -238,19 +1493,383 @@ def nice_ref_label(ref):
 
     return label
 
-def main(repo_dir, options):
-    emit_repo_as_xdot(dulwich.repo.Repo(repo_dir), options)
+class RenderServer(object):
+    '''Answers render requests from a long-lived process.
 
-if __name__ == '__main__':
-    from optparse import OptionParser
-    parser = OptionParser()
+    Requests and responses are single lines of JSON:
+
+        {"id": 1, "repo": "/path/to/repo", "args": ["--no-blobs"]}
+        {"id": 1, "output": "digraph G { ... }"}
+
+    "args" takes the same options as the command line. On failure the
+    response has an "error" string instead of "output".
+
+    A request with a "base" asks for what changed since an earlier render.
+    Its response has a "version" naming this render, and instead of
+    "output", a "delta" (see model_delta()) if "base" is the version of the
+    last render of the same repository and args. Pass null as the first
+    base. Deltas are of the graph model, so a "base" is only taken with
+    --format=json, and a version names the args it was rendered with as
+    well, so it is never the base for a render with other args.
+
+    With "quiet" set, the repository is rendered but the output is left
+    out of the response; that just warms the caches for a later request.
+
+    dulwich Repo handles are kept open between requests, so their pack
+    indexes and pack data don't have to be rediscovered and reopened each
+    time, along with one ObjectReader and ObjectCache per repository. The
+    walked graph for each repository and set of args is kept too, so that
+    later renders only walk new objects, up to REPO_GRAPH_LIMIT of them.
+    '''
+
+    def __init__(self):
+        self.repos = {}
+        self.objects = {} # repo dir -> (ObjectReader, ObjectCache) its RepoGraphs share
+        self.repo_graphs = collections.OrderedDict() # least recently used first
+        self.packed_refs_stats = {}
+        self.instance = os.urandom(4).encode('hex') # so versions aren't reused by a restarted server
+        self.renders = 0
+
+    def get_repo(self, repo_dir):
+        repo_dir = os.path.realpath(repo_dir)
+        repo = self.repos.get(repo_dir)
+        if repo is None:
+            repo = self.repos[repo_dir] = dulwich.repo.Repo(repo_dir)
+
+        # dulwich reads packed-refs once and never again, so start over with
+        # a fresh refs container whenever git rewrites it.
+        packed_refs_stat = file_stat(os.path.join(repo.controldir(), 'packed-refs'))
+        if self.packed_refs_stats.get(repo_dir, packed_refs_stat) != packed_refs_stat:
+            repo.refs = dulwich.repo.DiskRefsContainer(repo.controldir())
+        self.packed_refs_stats[repo_dir] = packed_refs_stat
+
+        return repo
+
+    def get_objects(self, repo_dir, options):
+        '''Returns the (ObjectReader, ObjectCache) for a repository. The
+        cache grows to the largest --object-cache-mb asked for.'''
+
+        repo_dir = os.path.realpath(repo_dir)
+        max_bytes = options.object_cache_mb * 1024 * 1024
+        objects = self.objects.get(repo_dir)
+        if objects is None:
+            reader = gitstore.ObjectReader(self.get_repo(repo_dir).object_store)
+            objects = self.objects[repo_dir] = (reader, gitstore.ObjectCache(max_bytes))
+        elif objects[1].max_bytes < max_bytes:
+            objects[1].resize(max_bytes)
+        return objects
+
+    def get_repo_graph(self, repo_dir, args, options):
+        key = (os.path.realpath(repo_dir), tuple(args))
+        repo_graph = self.repo_graphs.pop(key, None)
+        if repo_graph is None:
+            reader, cache = self.get_objects(repo_dir, options)
+            repo_graph = RepoGraph(self.get_repo(repo_dir), options, reader, cache)
+        self.repo_graphs[key] = repo_graph # now the most recently used
+
+        while len(self.repo_graphs) > REPO_GRAPH_LIMIT:
+            self.repo_graphs.popitem(last=False)[1].close()
+        return repo_graph
+
+    def forget_repo(self, repo_dir):
+        repo_dir = os.path.realpath(repo_dir)
+        self.repos.pop(repo_dir, None)
+        self.packed_refs_stats.pop(repo_dir, None)
+        for key in self.repo_graphs.keys():
+            if key[0] == repo_dir:
+                self.repo_graphs.pop(key).close()
+        objects = self.objects.pop(repo_dir, None)
+        if objects is not None:
+            objects[0].close()
+
+    def handle(self, request):
+        response = dict(id=request.get('id'))
+        repo_dir = request.get('repo')
+        try:
+            args = list(request.get('args', []))
+            options, _ = make_option_parser(RequestOptionParser).parse_args(args)
+            if 'base' in request and options.format != 'json':
+                raise ArgumentError('"base" needs --format=json, since deltas are of the graph model')
+            metrics = RenderMetrics()
+            repo_graph = self.get_repo_graph(repo_dir, args, options)
+            graph, model = render_repo_graph(self.get_repo(repo_dir), options, repo_graph, metrics)
+
+            output = None
+            if 'base' in request:
+                model_lists = metrics.timed('model', model.as_lists)
+                if request['base'] is not None and request['base'] == repo_graph.version:
+                    response['delta'] = metrics.timed('delta', model_delta, repo_graph.model, model_lists)
+                self.renders += 1
+                repo_graph.model = model_lists
+                repo_graph.version = response['version'] = '%s.%d.%s' % (
+                    self.instance, self.renders, args_digest(args))
+
+            if 'delta' not in response:
+                output = ''.join(iter_output(graph, model, options, metrics))
+            metrics.finish()
+        except Exception, e:
+            if isinstance(e, (OSError, IOError, KeyError)):
+                # the repository may have been moved or deleted out from
+                # under us; don't hang on to a handle that might be broken.
+                self.forget_repo(repo_dir or '')
+            response = dict(id=request.get('id'), error='%s: %s' % (e.__class__.__name__, e))
+        else:
+            if output is not None and not request.get('quiet'):
+                response['output'] = output.decode('utf-8', 'replace')
+            if options.metrics == '-':
+                response['metrics'] = metrics.as_dict()
+            elif options.metrics:
+                write_metrics(metrics, options.metrics)
+
+        return response
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError, e:
+            response = dict(id=None, error='invalid request: %s' % e)
+        else:
+            response = self.handle(request)
+
+        return json.dumps(response) + '\n'
+
+def args_digest(args):
+    'A short name for a list of request args, for render versions.'
+
+    return hashlib.sha1(json.dumps(args)).hexdigest()[:8]
+
+def file_stat(path):
+    'Returns a tuple that changes whenever the file at path does, or None if it is missing.'
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def serve_stdio(server):
+    'Answer requests on stdin with responses on stdout, until stdin closes.'
+
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip(): continue
+        sys.stdout.write(server.handle_line(line))
+        sys.stdout.flush()
+
+def serve_unix_socket(server, path):
+    '''Answer requests from any number of connections to a Unix socket at path.
+
+    Each connection gets its own thread, but requests are answered one at
+    a time, since the RenderServer's repositories and graphs are shared.'''
+
+    import SocketServer
+
+    lock = threading.Lock()
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            for line in iter(self.rfile.readline, ''):
+                if not line.strip(): continue
+                with lock:
+                    response = server.handle_line(line)
+                self.wfile.write(response)
+                self.wfile.flush()
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True # don't wait for connected clients on the way out
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    socket_server = Server(path, Handler)
+    try:
+        socket_server.serve_forever()
+    finally:
+        socket_server.server_close()
+        os.unlink(path)
+
+class RequestOptionParser(optparse.OptionParser):
+    '''Parses the args of a render request, raising ArgumentError for bad
+    ones instead of exiting, since the server has to keep running.'''
+
+    def error(self, msg):
+        raise ArgumentError(msg)
+
+    def exit(self, status=0, msg=None):
+        raise ArgumentError(msg or 'exit requested')
+
+    def print_help(self, file=None):
+        pass # stdout is where responses go
+
+    def print_version(self, file=None):
+        pass
+
+def check_positive(option, opt, value, parser):
+    'An optparse callback for int options that have to be at least 1.'
+
+    if value < 1:
+        parser.error('%s must be at least 1' % opt)
+    setattr(parser.values, option.dest, value)
+
+def make_option_parser(parser_class=optparse.OptionParser):
+    parser = parser_class(usage='%prog [options] REPO_DIR\n       %prog --batch [options] DIR...')
     parser.add_option("--no-blobs",
                       action="store_false", dest="blobs", default=True,
                       help="don't show blobs")
     parser.add_option("--no-index",
                       action="store_false", dest="index", default=True,
                       help="don't show the index")
+    parser.add_option("--no-worktree",
+                      action="store_false", dest="worktree", default=True,
+                      help="don't mark blobs that differ from the working tree")
+    parser.add_option("--collapse-unchanged",
+                      action="store_true", dest="collapse_unchanged", default=False,
+                      help="only draw what changed in each commit's tree since its first parent's, "
+                           "with one edge to the parent's tree for everything else")
+    parser.add_option("--walk-order",
+                      dest="walk_order", default="dfs", choices=("dfs", "bfs"),
+                      help="walk objects depth-first (dfs, the default) or breadth-first (bfs)")
+    parser.add_option("--object-cache-mb",
+                      dest="object_cache_mb", type="int", default=64, metavar="MB",
+                      help="keep up to this many megabytes of parsed objects in memory")
+    parser.add_option("--jobs",
+                      dest="jobs", type="int", default=1, metavar="N",
+                      help="decode new objects in N processes before walking them, for "
+                           "repositories with a lot of objects (only decoding is parallel, so "
+                           "the walk gets at most about 2x faster), or with --batch, render N "
+                           "repositories at once (0 for one per CPU)")
+    parser.add_option("--max-commits",
+                      action="callback", callback=check_positive,
+                      dest="max_commits", type="int", metavar="N",
+                      help="only show the N most recent commits")
+    parser.add_option("--since",
+                      dest="since", metavar="DATE",
+                      help="only show commits made since DATE (YYYY-MM-DD [HH:MM[:SS]], or a unix timestamp)")
+    parser.add_option("--range",
+                      dest="range", metavar="A..B",
+                      help="only show commits reachable from B but not from A, like git log A..B")
+    parser.add_option("--refs",
+                      action="append", dest="refs", metavar="GLOB",
+                      help="only show refs matching GLOB, like 'refs/heads/*' (can be repeated; "
+                           "HEAD is always shown, and partial views only walk back from the refs shown)")
+    parser.add_option("--exclude-refs",
+                      action="append", dest="exclude_refs", metavar="GLOB",
+                      help="don't show refs matching GLOB (can be repeated)")
+    parser.add_option("--layout",
+                      dest="layout", default="dot", choices=("dot", "lanes"),
+                      help="lay out with dot (the default), or in lanes like git log --graph "
+                           "(needs numpy and --no-blobs, otherwise dot is used)")
+    parser.add_option("--format",
+                      dest="format", default="xdot", choices=("xdot", "json"),
+                      help="write laid out xdot (the default), or the nodes and edges as JSON "
+                           "for clients that lay the graph out themselves")
+    parser.add_option("--layout-cache",
+                      dest="layout_cache", default=layoutcache.default_directory(), metavar="DIR",
+                      help="keep dot's layouts in DIR (default %default)")
+    parser.add_option("--layout-cache-mb",
+                      dest="layout_cache_mb", type="int", default=100, metavar="MB",
+                      help="keep up to this many megabytes of layouts on disk (0 turns the cache off)")
+    parser.add_option("--metrics",
+                      dest="metrics", metavar="FILE",
+                      help="append stage timings and counters for the render to FILE as JSON ('-' for stderr)")
+    parser.add_option("--serve",
+                      action="store_true", dest="serve", default=False,
+                      help="stay running and answer JSON render requests on stdin")
+    parser.add_option("--socket",
+                      dest="socket", metavar="PATH",
+                      help="stay running and answer JSON render requests on a Unix socket")
+    parser.add_option("--batch",
+                      action="store_true", dest="batch", default=False,
+                      help="render every repository under each of the given directories (or the "
+                           "directory itself, if it is one) to warm the layout cache, --jobs at a time, "
+                           "and report on each as a line of JSON")
+    return parser
+
+def is_repo_dir(path):
+    'Whether path is a repository, with a .git or bare, by the same test as gitutil.js.'
+
+    if os.path.exists(os.path.join(path, '.git')):
+        return True
+    return all(os.path.exists(os.path.join(path, name)) for name in ('hooks', 'info', 'objects', 'refs'))
+
+def find_repos(root):
+    'Returns the repositories directly under root, like gitutil.js\'s listRepos().'
+
+    paths = [os.path.join(root, name) for name in sorted(os.listdir(root))]
+    return [path for path in paths if os.path.isdir(path) and is_repo_dir(path)]
+
+def render_batch(dirs, options):
+    '''Renders every repository in dirs, or under them for directories that
+    aren't repositories themselves, and throws the output away, so that their
+    layouts are in the layout cache before anyone asks for them.
+
+    options.jobs repositories are rendered at a time, each in its own
+    process. Yields a dict for each one as it finishes, with how long it took
+    or what went wrong.'''
+
+    repo_dirs = []
+    for path in dirs:
+        repo_dirs.extend([path] if is_repo_dir(path) else find_repos(path))
+
+    jobs = options.jobs
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(repo_dirs))
+
+    if jobs < 2:
+        for repo_dir in repo_dirs:
+            yield render_batch_repo((repo_dir, options))
+        return
+
+    # the workers can't start decoding processes of their own
+    worker_options = copy.copy(options)
+    worker_options.jobs = 1
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(render_batch_repo, [(repo_dir, worker_options) for repo_dir in repo_dirs]):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def render_batch_repo(args):
+    'Renders one repository for render_batch().'
+
+    repo_dir, options = args
+    metrics = RenderMetrics()
+    result = dict(repo=repo_dir)
+    try:
+        render_repo_as_xdot(dulwich.repo.Repo(repo_dir), options, metrics=metrics)
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    else:
+        result.update(seconds=metrics.total_seconds, layout=metrics.layout,
+                      layout_cache_hit=metrics.layout_cache_hit)
+    return result
+
+def main(repo_dir, options):
+    metrics = RenderMetrics()
+    emit_repo_as_xdot(dulwich.repo.Repo(repo_dir), options, metrics)
+    if options.metrics:
+        write_metrics(metrics, options.metrics)
+
+if __name__ == '__main__':
+    parser = make_option_parser()
     options, args = parser.parse_args()
 
-    repo_dir = args[0]
-    main(repo_dir, options)
+    if options.socket:
+        serve_unix_socket(RenderServer(), options.socket)
+    elif options.serve:
+        serve_stdio(RenderServer())
+    elif options.batch:
+        if not args:
+            parser.error('expected directories of repositories')
+        for result in render_batch(args, options):
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            sys.stdout.flush()
+    else:
+        if len(args) != 1:
+            parser.error('expected a repository directory')
+        repo_dir = args[0]
+        main(repo_dir, options)
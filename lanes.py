@@ -0,0 +1,433 @@
+'''
+Lays out commit graphs in lanes, like git log --graph does, and writes them as
+xdot without running Graphviz.
+
+Nodes are ranked by generation: a node with no outgoing edges (a root commit)
+is rank 0, and every other node sits one rank above the highest of the nodes
+it points at. Within the ranks, each node gets a lane, and its first
+successor (a commit's first parent) carries on in the same lane. Ranks and
+lanes are assigned one node at a time in plain Python, in time linear in
+the size of the graph: each depends on the ones before it, down a chain as
+long as the history. Sizes and positions are then worked out for all nodes
+and edges at once with NumPy, which has to be installed.
+
+Only the shapes gitviz uses are drawn faithfully; anything else is drawn as a
+box. Labels are measured assuming a monospaced font.
+'''
+
+import pydot
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+XDOT_VERSION = '1.2'
+
+MIN_WIDTH = 54.0    # points, like dot's default width of 0.75 inches
+MIN_HEIGHT = 36.0   # points, like dot's default height of 0.5 inches
+MARGIN_X = 8.0      # space between a label and its node's edges, in points
+MARGIN_Y = 4.0
+CHAR_WIDTH = 0.6    # of the font size, for a monospaced font like Monaco
+LINE_HEIGHT = 1.2   # of the font size
+LANE_SEP = 18.0     # space between lanes
+RANK_SEP = 36.0     # space between ranks
+PAD = 4.0           # space around the whole drawing
+ARROW_LENGTH = 10.0
+ARROW_WIDTH = 7.0
+NOTE_CORNER = 6.0   # size of the folded corner on shape=note
+
+# shapes that need more room around their label than a box does
+SHAPE_SCALES = dict(diamond=1.6, invtriangle=1.8, triangle=1.8, ellipse=1.3)
+
+DEFAULT_FONTNAME = 'Times-Roman'
+DEFAULT_FONTSIZE = 14.0
+
+
+def available():
+    'Returns True if the lanes layout can be used at all.'
+
+    return numpy is not None
+
+def layout(graph):
+    'Lays out a pydot graph and returns it as xdot text.'
+
+    graph_attrs, names, node_attrs, edges = collect(graph)
+    index = dict((name, i) for i, name in enumerate(names))
+
+    src = numpy.array([index[a] for a, b, attrs in edges], dtype=int)
+    dst = numpy.array([index[b] for a, b, attrs in edges], dtype=int)
+
+    succs = [[] for name in names]
+    preds = [[] for name in names]
+    for a, b in zip(src.tolist(), dst.tolist()):
+        if a == b: continue
+        succs[a].append(b)
+        preds[b].append(a)
+
+    ranks = assign_ranks(succs, preds)
+    lanes = assign_lanes(succs, ranks)
+
+    labels = [label_lines(attrs.get('label'), name) for name, attrs in zip(names, node_attrs)]
+    fontsizes = numpy.array([float(attrs.get('fontsize', DEFAULT_FONTSIZE)) for attrs in node_attrs])
+    widths, heights = node_sizes(labels, fontsizes, [attrs.get('shape') for attrs in node_attrs])
+    xs, ys, bb = positions(numpy.array(ranks, dtype=int), numpy.array(lanes, dtype=int), widths, heights)
+
+    return ''.join(iter_xdot(graph, graph_attrs, names, node_attrs, labels, fontsizes,
+                             xs, ys, widths, heights, bb, edges, src, dst))
+
+def collect(graph):
+    '''Returns (graph_attrs, node names, node attributes, edges) for a pydot
+    graph, with node and edge defaults already applied and each node's
+    repeated statements merged into one.
+
+    Edges are (source name, destination name, attributes) tuples.'''
+
+    graph_attrs = dict(graph.obj_dict['attributes'])
+    names = []
+    nodes = {}
+    edges = []
+
+    def add_node(name, attrs, defaults):
+        if name not in nodes:
+            names.append(name)
+            nodes[name] = dict(defaults)
+        nodes[name].update(attrs)
+
+    def walk(obj_dict, node_defaults, edge_defaults):
+        node_defaults = dict(node_defaults)
+        edge_defaults = dict(edge_defaults)
+
+        children = []
+        for key in ('nodes', 'edges', 'subgraphs'):
+            for obj_dicts in obj_dict.get(key, {}).itervalues():
+                children.extend(obj_dicts)
+        children.sort(key=lambda child: child['sequence'])
+
+        for child in children:
+            if child['type'] == 'node':
+                name, attrs = child['name'], child['attributes']
+                if name == 'node':
+                    node_defaults.update(attrs)
+                elif name == 'edge':
+                    edge_defaults.update(attrs)
+                elif name == 'graph':
+                    graph_attrs.update(attrs)
+                else:
+                    add_node(name, attrs, node_defaults)
+            elif child['type'] == 'edge':
+                a, b = child['points']
+                add_node(a, {}, node_defaults)
+                add_node(b, {}, node_defaults)
+                attrs = dict(edge_defaults)
+                attrs.update(child['attributes'])
+                edges.append((a, b, attrs))
+            else:
+                walk(child, node_defaults, edge_defaults)
+
+    walk(graph.obj_dict, {}, {})
+    return graph_attrs, names, [nodes[name] for name in names], edges
+
+def assign_ranks(succs, preds):
+    '''Returns each node's rank: 0 for nodes with no successors, and one more
+    than the highest-ranked successor for everything else.'''
+
+    ranks = [0] * len(succs)
+    remaining = [len(s) for s in succs]
+    ready = [i for i, count in enumerate(remaining) if count == 0]
+    done = 0
+
+    while done < len(succs):
+        if not ready:
+            # a cycle; break it at the first node we haven't ranked.
+            ready.append(remaining.index(min(count for count in remaining if count > 0)))
+            remaining[ready[-1]] = 0
+
+        while ready:
+            node = ready.pop()
+            done += 1
+            rank = ranks[node] + 1
+            for pred in preds[node]:
+                if ranks[pred] < rank:
+                    ranks[pred] = rank
+                remaining[pred] -= 1
+                if remaining[pred] == 0:
+                    ready.append(pred)
+
+    return ranks
+
+def assign_lanes(succs, ranks):
+    '''Returns each node's lane, working from the highest rank down.
+
+    A node takes over the leftmost lane that was waiting for it, or the
+    leftmost free lane if none was. Its first successor then waits in the
+    same lane, and any other successors that aren't already waited for get
+    lanes of their own. Lanes that end are only reused from the next rank
+    on, so two nodes in one rank never share a lane.'''
+
+    order = sorted(range(len(succs)), key=lambda node: -ranks[node])
+    busy = []
+    waiting = {} # node -> lanes waiting for it
+    lanes = [-1] * len(succs)
+    ending = []
+    current_rank = None
+
+    def free_lane():
+        for lane, is_busy in enumerate(busy):
+            if not is_busy:
+                busy[lane] = True
+                return lane
+        busy.append(True)
+        return len(busy) - 1
+
+    for node in order:
+        if ranks[node] != current_rank:
+            for lane in ending:
+                busy[lane] = False
+            ending = []
+            current_rank = ranks[node]
+
+        waited = waiting.pop(node, [])
+        if waited:
+            lane = min(waited)
+            ending.extend(l for l in waited if l != lane)
+        else:
+            lane = free_lane()
+        lanes[node] = lane
+
+        successors = [succ for succ in succs[node] if lanes[succ] == -1]
+        if not successors:
+            ending.append(lane)
+            continue
+
+        waiting.setdefault(successors[0], []).append(lane)
+        for succ in successors[1:]:
+            if succ not in waiting:
+                waiting[succ] = [free_lane()]
+
+    return lanes
+
+def label_lines(label, name):
+    'Splits a DOT label into the lines it will be drawn as.'
+
+    if label is None:
+        label = name
+    if len(label) > 1 and label[0] == label[-1] == '"':
+        label = label[1:-1]
+    if label == r'\N':
+        label = name
+
+    lines = []
+    line = []
+    chars = iter(label)
+    for c in chars:
+        if c == '\n':
+            lines.append(''.join(line))
+            line = []
+        elif c == '\\':
+            c = next(chars, '')
+            if c in ('n', 'l', 'r'):
+                lines.append(''.join(line))
+                line = []
+            else:
+                line.append(c)
+        else:
+            line.append(c)
+    lines.append(''.join(line))
+
+    return lines
+
+def node_sizes(labels, fontsizes, shapes):
+    'Returns arrays of node widths and heights, in points.'
+
+    longest = numpy.array([max(len(line) for line in lines) for lines in labels], dtype=float)
+    num_lines = numpy.array([len(lines) for lines in labels], dtype=float)
+    scales = numpy.array([SHAPE_SCALES.get(shape, 1.0) for shape in shapes])
+
+    widths = numpy.maximum(MIN_WIDTH, (longest * fontsizes * CHAR_WIDTH + 2 * MARGIN_X) * scales)
+    heights = numpy.maximum(MIN_HEIGHT, (num_lines * fontsizes * LINE_HEIGHT + 2 * MARGIN_Y) * scales)
+    return widths, heights
+
+def positions(ranks, lanes, widths, heights):
+    '''Returns arrays of node centers, and the bounding box of the drawing.
+
+    Each lane is as wide as its widest node and each rank as tall as its
+    tallest, with rank 0 at the bottom like Graphviz's coordinates.'''
+
+    lane_widths = numpy.zeros(lanes.max() + 1 if len(lanes) else 0)
+    numpy.maximum.at(lane_widths, lanes, widths)
+    lane_lefts = PAD + numpy.concatenate(([0.0], numpy.cumsum(lane_widths + LANE_SEP)[:-1]))
+
+    rank_heights = numpy.zeros(ranks.max() + 1 if len(ranks) else 0)
+    numpy.maximum.at(rank_heights, ranks, heights)
+    rank_bottoms = PAD + numpy.concatenate(([0.0], numpy.cumsum(rank_heights + RANK_SEP)[:-1]))
+
+    xs = lane_lefts[lanes] + lane_widths[lanes] / 2
+    ys = rank_bottoms[ranks] + rank_heights[ranks] / 2
+
+    width = lane_lefts[-1] + lane_widths[-1] + PAD if len(lanes) else 2 * PAD
+    height = rank_bottoms[-1] + rank_heights[-1] + PAD if len(ranks) else 2 * PAD
+    return xs, ys, (0.0, 0.0, width, height)
+
+def edge_splines(src, dst, xs, ys, heights):
+    '''Returns a (num_edges, 4, 2) array of bezier control points running from
+    the bottom of each source node to just above the top of its destination,
+    and a (num_edges, 2) array of where the arrowheads point.'''
+
+    x0 = xs[src]
+    y0 = ys[src] - heights[src] / 2
+    tip_x = xs[dst]
+    tip_y = ys[dst] + heights[dst] / 2
+    y3 = tip_y + ARROW_LENGTH
+    bend = (y0 - y3) / 2
+
+    points = numpy.empty((len(src), 4, 2))
+    points[:, 0, 0] = x0
+    points[:, 0, 1] = y0
+    points[:, 1, 0] = x0
+    points[:, 1, 1] = y0 - bend
+    points[:, 2, 0] = tip_x
+    points[:, 2, 1] = y3 + bend
+    points[:, 3, 0] = tip_x
+    points[:, 3, 1] = y3
+    return points, numpy.column_stack((tip_x, tip_y))
+
+def fmt(n):
+    return ('%.2f' % n).rstrip('0').rstrip('.')
+
+def xdot_text(s):
+    'A string argument to an xdot operation, like a color or some text.'
+
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return '%d -%s' % (len(s), s)
+
+def xdot_str(op, s):
+    return '%s %s' % (op, xdot_text(s))
+
+def xdot_points(op, points):
+    return '%s %d %s' % (op, len(points), ' '.join('%s %s' % (fmt(x), fmt(y)) for x, y in points))
+
+def style_ops(style):
+    ops = []
+    for s in (style or '').split(','):
+        s = s.strip()
+        if s in ('dashed', 'dotted', 'bold'):
+            ops.append(xdot_str('S', s))
+    return ops
+
+def node_draw(attrs, x, y, w, h):
+    'Returns the _draw_ operations for a node.'
+
+    style = attrs.get('style') or ''
+    filled = 'filled' in style
+    ops = style_ops(style)
+    ops.append(xdot_str('c', unquote(attrs.get('color', 'black'))))
+    if filled:
+        ops.append(xdot_str('C', unquote(attrs.get('fillcolor', attrs.get('color', 'lightgrey')))))
+
+    left, right, top, bottom = x - w / 2, x + w / 2, y + h / 2, y - h / 2
+    shape = attrs.get('shape')
+    polygon = 'P' if filled else 'p'
+
+    if shape == 'ellipse':
+        ops.append('%s %s %s %s %s' % ('E' if filled else 'e', fmt(x), fmt(y), fmt(w / 2), fmt(h / 2)))
+    elif shape == 'diamond':
+        ops.append(xdot_points(polygon, [(x, top), (left, y), (x, bottom), (right, y)]))
+    elif shape == 'invtriangle':
+        ops.append(xdot_points(polygon, [(left, top), (right, top), (x, bottom)]))
+    elif shape == 'note':
+        corner = NOTE_CORNER
+        ops.append(xdot_points(polygon, [(right - corner, top), (left, top), (left, bottom),
+                                         (right, bottom), (right, top - corner)]))
+        ops.append(xdot_points('p', [(right - corner, top), (right - corner, top - corner),
+                                     (right, top - corner)]))
+    else:
+        ops.append(xdot_points(polygon, [(right, top), (left, top), (left, bottom), (right, bottom)]))
+
+    return ' '.join(ops) + ' '
+
+def label_draw(attrs, lines, x, y, fontsize):
+    'Returns the _ldraw_ operations for some centered lines of text.'
+
+    line_height = fontsize * LINE_HEIGHT
+    ops = ['F %s %s' % (fmt(fontsize), xdot_text(unquote(attrs.get('fontname', DEFAULT_FONTNAME)))),
+           xdot_str('c', unquote(attrs.get('fontcolor', 'black')))]
+
+    for i, line in enumerate(lines):
+        baseline = y + ((len(lines) - 1) / 2.0 - i) * line_height - fontsize / 3
+        width = len(line) * fontsize * CHAR_WIDTH
+        ops.append('T %s %s 0 %s %s' % (fmt(x), fmt(baseline), fmt(width), xdot_text(line)))
+
+    return ' '.join(ops) + ' '
+
+def unquote(value):
+    value = str(value)
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    return value
+
+def attr_list(attrs):
+    return ', '.join('%s=%s' % (name, pydot.quote_if_necessary(value))
+                     for name, value in attrs.iteritems() if value is not None)
+
+def iter_xdot(graph, graph_attrs, names, node_attrs, labels, fontsizes,
+              xs, ys, widths, heights, bb, edges, src, dst):
+    'Generates the laid out graph as xdot text, in the same shape dot -Txdot writes it.'
+
+    graph_attrs = dict(graph_attrs)
+    graph_attrs['bb'] = ','.join(fmt(n) for n in bb)
+    graph_attrs['xdotversion'] = XDOT_VERSION
+    if 'bgcolor' in graph_attrs:
+        bgcolor = unquote(graph_attrs['bgcolor'])
+        corners = [(bb[0], bb[1]), (bb[0], bb[3]), (bb[2], bb[3]), (bb[2], bb[1])]
+        graph_attrs['_draw_'] = ' '.join([xdot_str('c', bgcolor), xdot_str('C', bgcolor),
+                                          xdot_points('P', corners)]) + ' '
+
+    yield '%s %s {\n' % (graph.obj_dict['type'], graph.obj_dict['name'])
+    yield '\tgraph [%s];\n' % attr_list(graph_attrs)
+    yield '\tnode [label="\\N"];\n'
+
+    for i, name in enumerate(names):
+        attrs = dict(node_attrs[i])
+        x, y, w, h = xs[i], ys[i], widths[i], heights[i]
+        attrs.update(
+            pos='%s,%s' % (fmt(x), fmt(y)),
+            width=fmt(w / 72.0),
+            height=fmt(h / 72.0),
+            _draw_=node_draw(attrs, x, y, w, h),
+            _ldraw_=label_draw(attrs, labels[i], x, y, fontsizes[i]),
+        )
+        yield '\t%s [%s];\n' % (name, attr_list(attrs))
+
+    points, tips = edge_splines(src, dst, xs, ys, heights)
+    arrow = pydot.Graph.get_top_graph_type(graph) == 'digraph'
+    for i, (a, b, attrs) in enumerate(edges):
+        attrs = dict(attrs)
+        spline = points[i].tolist()
+        tip_x, tip_y = tips[i]
+        color = unquote(attrs.get('color', 'black'))
+        ops = style_ops(attrs.get('style')) + [xdot_str('c', color), xdot_points('B', spline)]
+        attrs['_draw_'] = ' '.join(ops) + ' '
+
+        if arrow:
+            attrs['pos'] = 'e,%s,%s %s' % (fmt(tip_x), fmt(tip_y),
+                                           ' '.join('%s,%s' % (fmt(px), fmt(py)) for px, py in spline))
+            head = [(tip_x - ARROW_WIDTH / 2, tip_y + ARROW_LENGTH), (tip_x, tip_y),
+                    (tip_x + ARROW_WIDTH / 2, tip_y + ARROW_LENGTH)]
+            attrs['_hdraw_'] = ' '.join([xdot_str('S', 'solid'), xdot_str('c', color),
+                                         xdot_str('C', color), xdot_points('P', head)]) + ' '
+        else:
+            attrs['pos'] = ' '.join('%s,%s' % (fmt(px), fmt(py)) for px, py in spline)
+
+        if attrs.get('label'):
+            lines = label_lines(attrs['label'], '')
+            fontsize = float(attrs.get('fontsize', DEFAULT_FONTSIZE))
+            lx = (spline[1][0] + spline[2][0]) / 2 + max(len(line) for line in lines) * fontsize * CHAR_WIDTH / 2
+            ly = (spline[1][1] + spline[2][1]) / 2
+            attrs['lp'] = '%s,%s' % (fmt(lx), fmt(ly))
+            attrs['_ldraw_'] = label_draw(attrs, lines, lx, ly, fontsize)
+
+        yield '\t%s %s %s [%s];\n' % (a, '->' if arrow else '--', b, attr_list(attrs))
+
+    yield '}\n'
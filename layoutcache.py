@@ -0,0 +1,137 @@
+'''
+An on-disk cache of xdot layouts, keyed by the DOT text they were made from.
+'''
+
+import errno
+import hashlib
+import os
+import tempfile
+
+SPOOL_CHUNK_SIZE = 64 * 1024
+DEFAULT_CACHE_BYTES = 100 * 1024 * 1024
+SUFFIX = '.xdot'
+
+
+def default_directory():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'gitviz', 'layouts')
+
+class LayoutCache(object):
+    '''Stores laid out graphs in a directory, one file per layout, named by
+    the sha1 of the layout program's version and the DOT text.
+
+    Files are touched when they're read, and the least recently used ones are
+    deleted once the directory holds more than max_bytes of layouts. The
+    directory can be shared by several processes; losing a race with another
+    one just means doing a layout again.
+
+    hits and misses count lookups, like gitstore.ObjectCache's.'''
+
+    def __init__(self, directory, version, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory
+        self.version = version
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def layout(self, chunks, run):
+        '''Returns the layout for the DOT text in chunks, calling run with an
+        iterable of DOT chunks to make it if it isn't cached.
+
+        The DOT text has to be hashed before the cache can be checked, so it
+        is spooled to a temporary file rather than held in memory.'''
+
+        digest = hashlib.sha1(self.version + '\0')
+        spool = tempfile.TemporaryFile()
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                spool.write(chunk)
+
+            key = digest.hexdigest()
+            xdot = self.get(key)
+            if xdot is not None:
+                return xdot
+
+            spool.seek(0)
+            xdot = run(iter(lambda: spool.read(SPOOL_CHUNK_SIZE), ''))
+        finally:
+            spool.close()
+
+        self.put(key, xdot)
+        return xdot
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        'Returns the cached layout for key, or None.'
+
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                xdot = f.read()
+            finally:
+                f.close()
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return xdot
+
+    def put(self, key, xdot):
+        '''Caches a layout, then trims the cache back down to size. Failing to
+        write to the cache isn't an error, since the layout is in hand.'''
+
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            # write somewhere else first so readers never see half a layout
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    f.write(xdot)
+                finally:
+                    f.close()
+                os.rename(tmp_path, self.path(key))
+            except:
+                os.unlink(tmp_path)
+                raise
+
+            self.evict()
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        'Deletes least recently used layouts until the cache fits in max_bytes.'
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX): continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes: break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
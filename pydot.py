@@ -145,6 +145,14 @@ id_re_with_port = re.compile('^([^:]*):([^:]*)$', re.UNICODE)
 id_re_dbl_quoted = re.compile('^\".*\"$', re.S|re.UNICODE)
 id_re_html = re.compile('^<.*>$', re.S|re.UNICODE)
 
+# All of the above that make an ID safe as-is, in one pattern, so
+# needs_quotes() only scans the string once in the common case.
+#
+id_re_safe = re.compile(
+    '^(?:[_a-zA-Z](?:[a-zA-Z0-9_,:\"]*[a-zA-Z0-9_,\"])?|[0-9,]+|\".*\"|<.*>)$',
+    re.S|re.UNICODE)
+id_re_non_ascii = re.compile(u'[\x00\x80-\uffff]', re.UNICODE)
+
 
 def needs_quotes( s ):
     """Checks whether a string is a dot language ID.
@@ -165,13 +173,14 @@ def needs_quotes( s ):
     if s in dot_keywords:
         return False
 
-    chars = [ord(c) for c in s if ord(c)>0x7f or ord(c)==0]
-    if chars and not id_re_dbl_quoted.match(s) and not id_re_html.match(s):
+    if id_re_safe.match(s):
+        return False
+
+    # Non-ASCII or NUL characters are only allowed in quoted or HTML
+    # IDs, which id_re_safe has already accepted.
+    #
+    if id_re_non_ascii.search(s):
         return True
-        
-    for test_re in [id_re_alpha_nums, id_re_num, id_re_dbl_quoted, id_re_html, id_re_alpha_nums_with_ports]:
-        if test_re.match(s):
-            return False
 
     m = id_re_with_port.match(s)
     if m:
@@ -180,19 +189,28 @@ def needs_quotes( s ):
     return True
 
 
-def quote_if_necessary(s):
+# Quoted forms of recently seen IDs, one dict per string type so a str
+# is never handed back for a unicode value or vice versa. A dict is
+# simply emptied once it holds QUOTE_CACHE_SIZE entries.
+#
+QUOTE_CACHE_SIZE = 8192
 
-    if isinstance(s, bool):
-        if s is True:
-            return 'True'
-        return 'False'
+quote_cache = { str: dict(), unicode: dict() }
 
-    if not isinstance( s, basestring ):
-        return s
 
-    if not s:
-        return s
-        
+def clear_quote_cache():
+    """Forget all the quoted forms remembered by quote_if_necessary()."""
+    
+    for cache in quote_cache.itervalues():
+        cache.clear()
+
+
+def quote(s):
+    """Returns the string as a dot language ID, quoting it if needed.
+    
+    Unlike quote_if_necessary() the result isn't cached.
+    """
+
     if needs_quotes(s):
         replace = {'"'  : r'\"',
                    "\n" : r'\n',
@@ -205,6 +223,44 @@ def quote_if_necessary(s):
     return s   
 
 
+def quote_if_necessary(s):
+    """Returns 's' ready to be written as a dot language ID.
+    
+    Booleans become 'True' or 'False', other non-strings and empty
+    strings are returned unchanged and strings go through quote().
+    Quoted forms are cached, since graphs repeat the same names,
+    fonts and colors many times over.
+    """
+
+    if isinstance(s, bool):
+        if s is True:
+            return 'True'
+        return 'False'
+
+    cache = quote_cache.get(type(s), None)
+    
+    if cache is None:
+    
+        if not isinstance( s, basestring ) or not s:
+            return s
+        
+        return quote(s)
+
+    quoted = cache.get(s, None)
+    
+    if quoted is None:
+    
+        if not s:
+            return s
+    
+        if len(cache) >= QUOTE_CACHE_SIZE:
+            cache.clear()
+        
+        quoted = cache[s] = quote(s)
+        
+    return quoted
+
+
 
 def graph_from_dot_data(data):
     """Load graph as defined by data in DOT format.
@@ -565,13 +621,18 @@ def find_graphviz():
     return None
     
 
-class Common:
+class Common(object):
     """Common information to several classes.
     
     Should not be directly used, several classes are derived from
     this one.
+    
+    Everything about an object lives in its obj_dict, so Node and Edge
+    declare no other slots and don't carry an instance __dict__.
     """
     
+    __slots__ = ('obj_dict',)
+    
 
     def __getstate__(self):
 
@@ -681,17 +742,46 @@ class Common:
         
         
     def create_attribute_methods(self, obj_attributes):
-    
-        #for attr in self.obj_dict['attributes']:
-        for attr in obj_attributes:
+        """Make sure set_'name' and get_'name' exist for the given attributes.
         
-            # Generate all the Setter methods.
-            #
-            self.__setattr__( 'set_'+attr, lambda x, a=attr : self.obj_dict['attributes'].__setitem__(a, x) )
-            
-            # Generate all the Getter methods.
-            #
-            self.__setattr__('get_'+attr, lambda a=attr : self.__get_attribute__(a))
+        The methods are defined once on the class, see add_attribute_methods().
+        """
+    
+        add_attribute_methods(self.__class__, obj_attributes)
+
+
+
+def make_attribute_methods(attr):
+    """Returns the set_'attr' and get_'attr' methods for an attribute."""
+
+    def setter(self, value):
+        self.obj_dict['attributes'][attr] = value
+
+    def getter(self):
+        return self.__get_attribute__(attr)
+
+    setter.__name__ = 'set_' + attr
+    getter.__name__ = 'get_' + attr
+
+    return setter, getter
+
+
+
+def add_attribute_methods(cls, obj_attributes):
+    """Define set_'name' and get_'name' methods on a class for each attribute.
+    
+    Doing this once per class, rather than adding closures to every
+    instance, keeps Nodes and Edges small and cheap to create.
+    """
+
+    for attr in obj_attributes:
+    
+        if 'set_' + attr in cls.__dict__:
+            continue
+    
+        setter, getter = make_attribute_methods(attr)
+        setattr(cls, setter.__name__, setter)
+        setattr(cls, getter.__name__, getter)
 
 
 
@@ -714,7 +804,7 @@ class InvocationException(Exception):
 
 
 
-class Node(object, Common):
+class Node(Common):
     """A graph node.
     
     This class represents a graph's node with all its attributes.
@@ -727,6 +817,8 @@ class Node(object, Common):
     be supported.
     """
 
+    __slots__ = ()
+
     def __repr__(self): return '<Node %s>' % self.obj_dict['name']
 
     def __init__(self, name = '', obj_dict = None, **attrs):
@@ -766,8 +858,6 @@ class Node(object, Common):
             self.obj_dict['name'] = quote_if_necessary( name )
             self.obj_dict['port'] = port
         
-        self.create_attribute_methods(NODE_ATTRIBUTES)
-        
     
     
     def set_name(self, node_name):
@@ -804,36 +894,42 @@ class Node(object, Common):
         """Returns a string representation of the node in dot language.
         """
         
-        
-        # RMF: special case defaults for node, edge and graph properties.
-        #
-        node = quote_if_necessary(self.obj_dict['name'])
+        return node_to_string(self.obj_dict)
 
-        node_attr = list()
 
-        for attr, value in self.obj_dict['attributes'].iteritems():
-            if value is not None:
-                node_attr.append( '%s=%s' % (attr, quote_if_necessary(value) ) )
-            else:
-                node_attr.append( attr )
-                
-                
-        # No point in having nodes setting any defaults if the don't set
-        # any attributes...
-        #
-        if node in ('graph', 'node', 'edge') and len(node_attr) == 0:
-            return ''
+
+def node_to_string(obj_dict):
+    """Returns the dot language statement for a node's obj_dict."""
+    
+    # RMF: special case defaults for node, edge and graph properties.
+    #
+    node = quote_if_necessary(obj_dict['name'])
+
+    node_attr = list()
+
+    for attr, value in obj_dict['attributes'].iteritems():
+        if value is not None:
+            node_attr.append( '%s=%s' % (attr, quote_if_necessary(value) ) )
+        else:
+            node_attr.append( attr )
+            
             
-        node_attr = ', '.join(node_attr)
+    # No point in having nodes setting any defaults if the don't set
+    # any attributes...
+    #
+    if node in ('graph', 'node', 'edge') and len(node_attr) == 0:
+        return ''
+        
+    node_attr = ', '.join(node_attr)
 
-        if node_attr:
-            node += ' [' + node_attr + ']'
+    if node_attr:
+        node += ' [' + node_attr + ']'
 
-        return node + ';'
+    return node + ';'
 
 
 
-class Edge(object,  Common ):
+class Edge(Common):
     """A graph edge.
     
     This class represents a graph's edge with all its attributes.
@@ -859,6 +955,8 @@ class Edge(object,  Common ):
         
     """
     
+    __slots__ = ()
+
     def __repr__(self):
         return '<Edge %s -> %s>' % self.obj_dict['points']
 
@@ -893,8 +991,6 @@ class Edge(object,  Common ):
             points = ( quote_if_necessary( src) , quote_if_necessary( dst) )
             
             self.obj_dict['points'] = points
-            
-        self.create_attribute_methods(EDGE_ATTRIBUTES)
 
 
     def get_source(self):
@@ -948,85 +1044,103 @@ class Edge(object,  Common ):
     
     def parse_node_ref(self, node_str):
     
-        if not isinstance(node_str, str):
-            return node_str
-    
-        if node_str.startswith('"') and node_str.endswith('"'):
-        
-            return node_str
-        
-        node_port_idx = node_str.rfind(':')
-        
-        if node_port_idx>0 and node_str[0]=='"' and node_str[node_port_idx-1]=='"':
-        
-            return node_str
-                
-        if node_port_idx>0:
-        
-            a = node_str[:node_port_idx]
-            b = node_str[node_port_idx+1:]
-
-            node = quote_if_necessary(a)
-
-            node += ':'+quote_if_necessary(b)
-
-            return node
-            
-        return node_str
+        return parse_node_ref(node_str)
         
     
     def to_string(self):
         """Returns a string representation of the edge in dot language.
         """
 
-        src = self.parse_node_ref( self.get_source() )
-        dst = self.parse_node_ref( self.get_destination() )
+        parent = self.get_parent_graph()
         
-        if isinstance(src, frozendict):
-            edge = [ Subgraph(obj_dict=src).to_string() ]
-        elif isinstance(src, (int, long)):
-            edge = [ str(src) ]
-        else:
-            edge = [ src ]
+        directed = parent is not None and parent.get_top_graph_type() == 'digraph'
         
-        if	(self.get_parent_graph() and
-            self.get_parent_graph().get_top_graph_type() and
-            self.get_parent_graph().get_top_graph_type() == 'digraph' ):
+        return edge_to_string(self.obj_dict, directed)
+    
+    
+    
+def parse_node_ref(node_str):
 
-            edge.append( '->' )
-            
-        else:
-            edge.append( '--' )
+    if not isinstance(node_str, str):
+        return node_str
+
+    if node_str.startswith('"') and node_str.endswith('"'):
+    
+        return node_str
+    
+    node_port_idx = node_str.rfind(':')
+    
+    if node_port_idx>0 and node_str[0]=='"' and node_str[node_port_idx-1]=='"':
+    
+        return node_str
             
-        if isinstance(dst, frozendict):
-            edge.append( Subgraph(obj_dict=dst).to_string() )
-        elif isinstance(dst, (int, long)):
-            edge.append( str(dst) )
-        else:
-            edge.append( dst )
+    if node_port_idx>0:
+    
+        a = node_str[:node_port_idx]
+        b = node_str[node_port_idx+1:]
 
+        node = quote_if_necessary(a)
 
-        edge_attr = list()
-        
-        for attr, value in self.obj_dict['attributes'].iteritems():
+        node += ':'+quote_if_necessary(b)
+
+        return node
         
-            if value is not None:
-                edge_attr.append( '%s=%s' % (attr, quote_if_necessary(value) ) )
-            else:
-                edge_attr.append( attr )
+    return node_str
+
 
-        edge_attr = ', '.join(edge_attr)
+
+def edge_to_string(obj_dict, directed):
+    """Returns the dot language statement for an edge's obj_dict.
+    
+    'directed' selects '->' over '--'; it comes from the top graph's
+    type, which a caller writing many edges only needs to look up once.
+    """
+
+    src, dst = obj_dict['points']
+    src = parse_node_ref( src )
+    dst = parse_node_ref( dst )
+    
+    if isinstance(src, frozendict):
+        edge = [ Subgraph(obj_dict=src).to_string() ]
+    elif isinstance(src, (int, long)):
+        edge = [ str(src) ]
+    else:
+        edge = [ src ]
+    
+    if directed:
+        edge.append( '->' )
+    else:
+        edge.append( '--' )
         
-        if edge_attr:
-            edge.append( ' [' + edge_attr + ']' )
+    if isinstance(dst, frozendict):
+        edge.append( Subgraph(obj_dict=dst).to_string() )
+    elif isinstance(dst, (int, long)):
+        edge.append( str(dst) )
+    else:
+        edge.append( dst )
+
 
-        return ' '.join(edge) + ';'
+    edge_attr = list()
+    
+    for attr, value in obj_dict['attributes'].iteritems():
+    
+        if value is not None:
+            edge_attr.append( '%s=%s' % (attr, quote_if_necessary(value) ) )
+        else:
+            edge_attr.append( attr )
+
+    edge_attr = ', '.join(edge_attr)
+    
+    if edge_attr:
+        edge.append( ' [' + edge_attr + ']' )
+
+    return ' '.join(edge) + ';'
     
     
     
     
     
-class Graph(object, Common):
+class Graph(Common):
     """Class representing a graph in Graphviz's dot language.
 
     This class implements the methods to work on a representation
@@ -1092,11 +1206,9 @@ class Graph(object, Common):
             self.obj_dict['nodes'] = dict()
             self.obj_dict['edges'] = dict()
             self.obj_dict['subgraphs'] = dict()
+            self.obj_dict['children'] = list()
 
             self.set_parent_graph(self)
-            
-
-        self.create_attribute_methods(GRAPH_ATTRIBUTES)
 
 
     def get_graph_type(self):
@@ -1265,6 +1377,50 @@ class Graph(object, Common):
         
 
 
+    def add_child(self, obj_dict):
+        """Records a node, edge or subgraph in the order it was added.
+        
+        Graphs restored from an obj_dict built before the ordered child
+        list existed have no 'children'; those fall back to sorting by
+        sequence number in get_child_obj_dicts().
+        """
+        
+        children = self.obj_dict.get('children', None)
+        
+        if children is not None:
+            children.append(obj_dict)
+
+
+    def del_children(self, obj_dicts):
+    
+        children = self.obj_dict.get('children', None)
+        
+        if children is not None:
+            removed = set( id(obj) for obj in obj_dicts )
+            children[:] = [ obj for obj in children if id(obj) not in removed ]
+
+
+    def get_child_obj_dicts(self):
+        """Get the obj_dicts of the nodes, edges and subgraphs in the order
+        they were added to the graph.
+        """
+        
+        children = self.obj_dict.get('children', None)
+        
+        if children is not None:
+            return children
+        
+        obj_list = list()
+        for key in ('edges', 'nodes', 'subgraphs'):
+            for obj_dict_list in self.obj_dict[key].itervalues():
+                obj_list.extend(obj_dict_list)
+        
+        obj_list.sort(key=lambda obj: obj['sequence'])
+        
+        return obj_list
+
+
+
     def add_node(self, graph_node):
         """Adds a node object to the graph.
 
@@ -1289,6 +1445,7 @@ class Graph(object, Common):
             self.obj_dict['nodes'][graph_node.get_name()].append( graph_node.obj_dict )
 
         graph_node.set_sequence(self.get_next_sequence_number())
+        self.add_child(graph_node.obj_dict)
 
 
 
@@ -1316,9 +1473,11 @@ class Graph(object, Common):
         if self.obj_dict['nodes'].has_key(name):
         
             if index is not None and index < len(self.obj_dict['nodes'][name]):
+                self.del_children( [self.obj_dict['nodes'][name][index]] )
                 del self.obj_dict['nodes'][name][index]
                 return True
             else:
+                self.del_children( self.obj_dict['nodes'][name] )
                 del self.obj_dict['nodes'][name]
                 return True
         
@@ -1390,6 +1549,7 @@ class Graph(object, Common):
 
 
         graph_edge.set_sequence( self.get_next_sequence_number() )
+        self.add_child(graph_edge.obj_dict)
 
         graph_edge.set_parent_graph( self.get_parent_graph() )
 
@@ -1428,9 +1588,11 @@ class Graph(object, Common):
         if self.obj_dict['edges'].has_key( (src, dst) ):
         
             if index is not None and index < len(self.obj_dict['edges'][(src, dst)]):
+                self.del_children( [self.obj_dict['edges'][(src, dst)][index]] )
                 del self.obj_dict['edges'][(src, dst)][index]
                 return True
             else:
+                self.del_children( self.obj_dict['edges'][(src, dst)] )
                 del self.obj_dict['edges'][(src, dst)]
                 return True
         
@@ -1509,6 +1671,7 @@ class Graph(object, Common):
             self.obj_dict['subgraphs'][ sgraph.get_name() ] = [ sgraph.obj_dict ]
          
         sgraph.set_sequence( self.get_next_sequence_number() )
+        self.add_child(sgraph.obj_dict)
         
         sgraph.set_parent_graph( self.get_parent_graph() )
 
@@ -1584,22 +1747,31 @@ class Graph(object, Common):
         It will return the graph and all its subelements in string from.
         """
         
+        return ''.join(self.iter_dot())
+
+
+
+    def iter_dot(self):
+        """Generates the graph in dot language, a piece at a time.
         
-        graph = list()
+        Joining all the pieces gives the same result as to_string(), but
+        the whole text never has to be held in memory at once. Useful for
+        writing large graphs straight into a file or a pipe.
+        """
         
         if self.obj_dict.get('strict', None) is not None:
         
             if self==self.get_parent_graph() and self.obj_dict['strict']:
             
-                graph.append('strict ')
+                yield 'strict '
 
         if self.obj_dict['name'] == '':
             if 'show_keyword' in self.obj_dict and self.obj_dict['show_keyword']:
-                graph.append( 'subgraph {\n' )
+                yield 'subgraph {\n'
             else:
-                graph.append( '{\n' )
+                yield '{\n'
         else:
-            graph.append( '%s %s {\n' % (self.obj_dict['type'], self.obj_dict['name']) )
+            yield '%s %s {\n' % (self.obj_dict['type'], self.obj_dict['name'])
 
 
         for attr in self.obj_dict['attributes'].iterkeys():
@@ -1608,71 +1780,62 @@ class Graph(object, Common):
        
                 val = self.obj_dict['attributes'].get(attr)
                 if val is not None:
-                    graph.append( '%s=%s' % (attr, quote_if_necessary(val)) )
+                    yield '%s=%s' % (attr, quote_if_necessary(val))
                 else:
-                    graph.append( attr )
+                    yield attr
                     
-                graph.append( ';\n' )
+                yield ';\n'
 
 
-        edges_done = set()
+        suppress_disconnected = self.obj_dict.get('suppress_disconnected', False)
+        simplify = self.obj_dict.get('simplify', False)
+        directed = self.get_top_graph_type() == 'digraph'
         
-        edge_obj_dicts = list()
-        for e in self.obj_dict['edges'].itervalues():
-            edge_obj_dicts.extend(e)
-            
-        if edge_obj_dicts:
-            edge_src_set, edge_dst_set = zip( *[obj['points'] for obj in edge_obj_dicts] )
-            edge_src_set, edge_dst_set = set(edge_src_set), set(edge_dst_set)
-        else:
-            edge_src_set, edge_dst_set = set(), set()
-            
-        node_obj_dicts = list()
-        for e in self.obj_dict['nodes'].itervalues():
-            node_obj_dicts.extend(e)
-
-        sgraph_obj_dicts = list()
-        for sg in self.obj_dict['subgraphs'].itervalues():
-            sgraph_obj_dicts.extend(sg)
+        if suppress_disconnected:
+            edge_points = set()
+            for obj_dict_list in self.obj_dict['edges'].itervalues():
+                for obj in obj_dict_list:
+                    edge_points.update(obj['points'])
 
+        edges_done = set()
         
-        obj_list = [ (obj['sequence'], obj) for obj in (edge_obj_dicts + node_obj_dicts + sgraph_obj_dicts) ]
-        obj_list.sort()
-        
-        for idx, obj in obj_list:
+        for obj in self.get_child_obj_dicts():
         
             if obj['type'] == 'node':
 
-                node = Node(obj_dict=obj)
-            
-                if self.obj_dict.get('suppress_disconnected', False):
-                
-                    if (node.get_name() not in edge_src_set and
-                        node.get_name() not in edge_dst_set):
-                        
-                        continue
+                if suppress_disconnected and obj['name'] not in edge_points:
+                    continue
                         
-                graph.append( node.to_string()+'\n' )
+                yield node_to_string(obj)+'\n'
 
             elif obj['type'] == 'edge':
 
-                edge = Edge(obj_dict=obj)
+                if simplify:
                 
-                if self.obj_dict.get('simplify', False) and edge in edges_done:
-                    continue
+                    # Same equality as Edge.__eq__: an undirected edge
+                    # matches its reverse.
+                    #
+                    if directed:
+                        key = obj['points']
+                    else:
+                        key = frozenset(obj['points'])
+                    
+                    if key in edges_done:
+                        continue
+                    
+                    edges_done.add(key)
                 
-                graph.append( edge.to_string() + '\n' )
-                edges_done.add(edge)
+                yield edge_to_string(obj, directed) + '\n'
                 
             else:
             
                 sgraph = Subgraph(obj_dict=obj)
                 
-                graph.append( sgraph.to_string()+'\n' )
+                for piece in sgraph.iter_dot():
+                    yield piece
+                yield '\n'
 
-        graph.append( '}\n' )
-        
-        return ''.join(graph)
+        yield '}\n'
 
 
 
@@ -1764,13 +1927,18 @@ class Cluster(Graph):
             self.obj_dict['type'] = 'subgraph'
             self.obj_dict['name'] = 'cluster_'+graph_name
 
-        self.create_attribute_methods(CLUSTER_ATTRIBUTES)
-
 
 
    
 
 
+add_attribute_methods(Node, NODE_ATTRIBUTES)
+add_attribute_methods(Edge, EDGE_ATTRIBUTES)
+add_attribute_methods(Graph, GRAPH_ATTRIBUTES)
+add_attribute_methods(Cluster, CLUSTER_ATTRIBUTES)
+
+
+
 class Dot(Graph):
     """A container for handling a dot language file.
 
@@ -1896,19 +2064,19 @@ class Dot(Graph):
         
         dot_fd = file(path, "w+b")
         if format == 'raw':
-            data = self.to_string()
-            if isinstance(data, basestring):
-                if not isinstance(data, unicode):
-                    try:
-                        data = unicode(data, 'utf-8')
-                    except:
-                        pass
-                        
-            try:
-                data = data.encode('utf-8')
-            except:
-                pass
-            dot_fd.write(data)
+            for data in self.iter_dot():
+                if isinstance(data, basestring):
+                    if not isinstance(data, unicode):
+                        try:
+                            data = unicode(data, 'utf-8')
+                        except:
+                            pass
+                            
+                try:
+                    data = data.encode('utf-8')
+                except:
+                    pass
+                dot_fd.write(data)
         else:
             dot_fd.write(self.create(prog, format))
         dot_fd.close()
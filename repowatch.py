@@ -0,0 +1,299 @@
+'''
+Watches the parts of a git repository that its graph is drawn from with Linux
+inotify, and says what kind of change each burst of events was.
+
+Run as a script, it prints a line of JSON for every burst, e.g.
+
+    {"changes": ["objects", "refs"]}
+
+With --worktree it also watches the working tree, for the blobs gitviz.py
+marks as differing from it.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import optparse
+import os
+import select
+import struct
+import sys
+import time
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# git writes files under a temporary name and renames (or links) them into
+# place, so watching directories for these catches every finished write.
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len of the name after it
+READ_SIZE = 64 * 1024
+SETTLE_SECONDS = 0.1 # a burst is over once there's been no event for this long
+MAX_BURST_SECONDS = 1.0 # but report at least this often while events keep coming
+
+REFS = 'refs'         # a ref, HEAD or packed-refs moved
+OBJECTS = 'objects'   # loose objects or packs were added or removed
+INDEX = 'index'       # the index was written
+WORKTREE = 'worktree' # a file in the index was written, moved or deleted in the working tree
+ALL_CHANGES = (INDEX, OBJECTS, REFS)
+
+# files directly in the control dir that matter
+CONTROLDIR_FILES = {'HEAD': REFS, 'packed-refs': REFS, 'index': INDEX}
+
+_libc = None
+
+def libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+def available():
+    'Whether inotify can be used here.'
+
+    try:
+        return hasattr(libc(), 'inotify_init1')
+    except OSError:
+        return False
+
+def os_error(path=None):
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code), path)
+
+class RepoWatcher(object):
+    '''Watches a repository's control dir for the changes that can change
+    its graph: the refs directory, packed-refs, HEAD, the index, objects/pack
+    and the loose object fan-out directories. Nothing elsewhere in the
+    control dir (logs, COMMIT_EDITMSG, ...) is watched, and the working tree
+    only is if it's given (see watch_worktree).
+
+    Every directory needs its own watch, so new directories under refs/ and
+    new fan-out directories are watched as they show up.'''
+
+    def __init__(self, controldir, worktree=None):
+        self.controldir = controldir
+        self.worktree = worktree
+        self.fd = libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise os_error()
+        self.watches = {} # watch descriptor -> (directory, what it is)
+        self.worktree_names = {} # working tree directory -> names in the index in it
+
+        self.watch(controldir, 'controldir')
+        self.watch_tree(os.path.join(controldir, 'refs'))
+        objects = os.path.join(controldir, 'objects')
+        self.watch(objects, 'objects')
+        self.watch(os.path.join(objects, 'pack'), 'pack')
+        for name in os.listdir(objects):
+            if is_fanout(name):
+                self.watch(os.path.join(objects, name), 'fanout')
+        if worktree is not None:
+            self.watch_worktree()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def watch(self, path, kind):
+        wd = libc().inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            error = os_error(path)
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                return # gone again already
+            raise error
+        self.watches[wd] = (path, kind)
+
+    def watch_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            self.watch(dirpath, 'refs')
+
+    def watch_worktree(self):
+        '''Watches the directories of the working tree that the index has
+        files in, and stops watching the ones it doesn't any more. Only the
+        names in the index count, so build output, editor swap files and
+        the like don't. Called again whenever the index is written.'''
+
+        names = {}
+        for path in read_index_paths(os.path.join(self.controldir, 'index')):
+            parts = path.split('/')
+            for i in range(len(parts)):
+                dirname = os.path.join(self.worktree, *parts[:i])
+                names.setdefault(dirname, set()).add(parts[i])
+
+        watched = set()
+        for wd, (path, kind) in self.watches.items():
+            if kind != 'worktree': continue
+            if path in names:
+                watched.add(path)
+            else:
+                libc().inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+        for dirname in set(names) - watched:
+            self.watch(dirname, 'worktree')
+        self.worktree_names = names
+
+    def read(self):
+        '''Returns the set of changes in the events that are waiting, without
+        blocking.'''
+
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return changes
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                changes.update(self.classify(wd, mask, name))
+
+    def classify(self, wd, mask, name):
+        'Returns the changes one event stands for, watching any new directory it names.'
+
+        if mask & IN_Q_OVERFLOW:
+            # events were dropped, so anything could have happened
+            return ALL_CHANGES + ((WORKTREE,) if self.worktree is not None else ())
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None) # the directory went away
+            return ()
+        if wd not in self.watches or not name:
+            return ()
+
+        path, kind = self.watches[wd]
+        created = mask & (IN_CREATE | IN_MOVED_TO)
+
+        if kind == 'controldir':
+            change = CONTROLDIR_FILES.get(name)
+            return (change,) if change else ()
+
+        if kind == 'refs':
+            if mask & IN_ISDIR:
+                if created:
+                    self.watch_tree(os.path.join(path, name))
+                return (REFS,) # a whole directory of refs may have been moved
+            return () if name.endswith('.lock') else (REFS,)
+
+        if kind == 'objects':
+            if mask & IN_ISDIR and created and is_fanout(name):
+                self.watch(os.path.join(path, name), 'fanout')
+                return (OBJECTS,) # objects may be in it before it's watched
+            if mask & IN_ISDIR and created and name == 'pack':
+                self.watch(os.path.join(path, name), 'pack')
+            return ()
+
+        if kind == 'fanout':
+            return () if name.startswith('tmp_') else (OBJECTS,)
+
+        if kind == 'pack':
+            if name.startswith('tmp_') or not name.endswith(('.pack', '.idx')):
+                return ()
+            return (OBJECTS,)
+
+        if kind == 'worktree':
+            if name not in self.worktree_names.get(path, ()):
+                return ()
+            child = os.path.join(path, name)
+            if mask & IN_ISDIR and created and child in self.worktree_names:
+                self.watch(child, 'worktree') # put back after being deleted
+            return (WORKTREE,)
+
+        return ()
+
+    def wait(self, timeout=None):
+        '''Waits for a burst of changes and returns them sorted, or [] if there
+        were none before timeout seconds.'''
+
+        changes = set()
+        start = None
+        while True:
+            if start is None:
+                wait = timeout
+            else:
+                wait = min(SETTLE_SECONDS, start + MAX_BURST_SECONDS - time.time())
+                if wait <= 0:
+                    break
+
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if not ready:
+                break
+
+            if start is None:
+                start = time.time()
+            changes.update(self.read())
+
+        if INDEX in changes and self.worktree is not None:
+            self.watch_worktree() # files may have been added to the index, or removed
+        return sorted(changes)
+
+def is_fanout(name):
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+def read_index_paths(index_path):
+    'Returns the paths in an index file, or [] if there is no index.'
+
+    import dulwich.index
+    try:
+        return list(dulwich.index.Index(index_path))
+    except (IOError, OSError):
+        return []
+
+def find_controldir(repo_dir):
+    '''Returns (control dir, working tree) for a repository: its .git
+    directory and the directory it's in, or itself and None if it is bare.'''
+
+    import dulwich.repo
+    repo = dulwich.repo.Repo(repo_dir)
+    return repo.controldir(), None if repo.bare else repo.path
+
+def main(repo_dir, worktree=False):
+    if not available():
+        sys.stderr.write('repowatch.py: inotify is not available\n')
+        return 2
+
+    controldir, worktree_dir = find_controldir(repo_dir)
+    watcher = RepoWatcher(controldir, worktree_dir if worktree else None)
+    try:
+        while True:
+            changes = watcher.wait()
+            if changes:
+                sys.stdout.write(json.dumps(dict(changes=changes)) + '\n')
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [--worktree] REPO_DIR')
+    parser.add_option('--worktree', action='store_true', default=False,
+                      help='also say when files in the index change in the working tree')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected one repository')
+    sys.exit(main(args[0], options.worktree))
@@ -0,0 +1,6 @@
+'''
+Tests for gitviz. Run them from the top of the checkout, with the dulwich
+submodule on the path as app.js puts it there:
+
+    PYTHONPATH=dulwich python -m unittest discover
+'''
@@ -0,0 +1,62 @@
+'''
+Tiny repositories for the tests, written with dulwich into temporary
+directories that are removed when the test is done.
+'''
+
+import dulwich.objects
+import dulwich.repo
+import os
+import shutil
+import tempfile
+
+AUTHOR = 'Test Case <test@example.com>'
+START_TIME = 1262304000 # 2010-01-01
+
+
+def make_repo(test):
+    'Returns a new, empty non-bare Repo that is removed after test.'
+
+    path = tempfile.mkdtemp(prefix='gitviz-test-')
+    test.addCleanup(shutil.rmtree, path)
+    return dulwich.repo.Repo.init(path)
+
+def write_file(repo, path, data):
+    full_path = os.path.join(repo.path, path)
+    if not os.path.isdir(os.path.dirname(full_path)):
+        os.makedirs(os.path.dirname(full_path))
+    f = open(full_path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+def stage(repo, files):
+    'Writes {path: data} to the working tree and adds the files to the index.'
+
+    for path, data in sorted(files.iteritems()):
+        write_file(repo, path, data)
+    repo.stage(sorted(files))
+
+def commit(repo, files, message='commit'):
+    '''Stages {path: data} and commits the index to HEAD's branch, and returns
+    the new commit's sha. Commits are an hour apart, in order.'''
+
+    stage(repo, files)
+    try:
+        commit_time = repo[repo.head()].commit_time + 3600
+    except KeyError:
+        commit_time = START_TIME # the first commit
+    return repo.do_commit(message, committer=AUTHOR, author=AUTHOR,
+                          commit_timestamp=commit_time, commit_timezone=0,
+                          author_timestamp=commit_time, author_timezone=0)
+
+def blob_in_dir(dirname, prefix='blob'):
+    '''Returns a Blob whose loose object would go in the given fan-out
+    directory, found by trying contents until one hashes there.'''
+
+    i = 0
+    while True:
+        blob = dulwich.objects.Blob.from_string('%s %d\n' % (prefix, i))
+        if blob.id.startswith(dirname):
+            return blob
+        i += 1
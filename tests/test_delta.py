@@ -0,0 +1,153 @@
+import gitviz
+import json
+import unittest
+
+from tests import repos
+
+
+def apply_delta(model, delta):
+    '''Applies a model_delta() to (nodes, edges) as a client would, and
+    returns the new (nodes, edges).'''
+
+    nodes, edges = model
+    nodes = [dict(node) for node in nodes if node['id'] not in delta.get('nodes_removed', ())]
+    by_id = dict((node['id'], node) for node in nodes)
+    for changed in delta.get('nodes_changed', ()):
+        node = by_id[changed['id']]
+        for key, value in changed.iteritems():
+            if value is None:
+                del node[key]
+            else:
+                node[key] = value
+    nodes.extend(delta.get('nodes_added', ()))
+
+    edges = list(edges)
+    for edge in delta.get('edges_removed', ()):
+        edges.remove(edge)
+    edges.extend(delta.get('edges_added', ()))
+    return nodes, edges
+
+def normalized(model):
+    'Nodes by id and edges sorted, since applying a delta doesn\'t keep their order.'
+
+    nodes, edges = model
+    key = lambda edge: sorted(edge.iteritems())
+    return dict((node['id'], node) for node in nodes), sorted(edges, key=key)
+
+
+class ModelDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old = (
+            [gitviz.model_node('a', 'commit', 'first'),
+             gitviz.model_node('b', 'tree', tooltip='a tree', color='red'),
+             gitviz.model_node('c', 'blob', 'c')],
+            [gitviz.model_edge('a', 'b'),
+             gitviz.model_edge('b', 'c', label='c.txt')])
+
+    def assertDelta(self, new, delta):
+        self.assertEqual(gitviz.model_delta(self.old, new), delta)
+        self.assertEqual(normalized(apply_delta(self.old, delta)), normalized(new))
+
+    def test_no_change(self):
+        self.assertDelta(self.old, {})
+
+    def test_nodes_added_and_removed(self):
+        d = gitviz.model_node('d', 'blob', 'd')
+        nodes, edges = self.old
+        self.assertDelta((nodes[:2] + [d], edges), {
+            'nodes_added': [d],
+            'nodes_removed': [u'c'],
+        })
+
+    def test_node_keys_changed_and_removed(self):
+        nodes, edges = self.old
+        b = gitviz.model_node('b', 'tree', 'a label', color='blue')
+        self.assertDelta(([nodes[0], b, nodes[2]], edges), {
+            'nodes_changed': [{'id': u'b', 'label': u'a label', 'tooltip': None, 'color': u'blue'}],
+        })
+
+    def test_changed_edge_is_removed_and_added(self):
+        nodes, edges = self.old
+        relabeled = gitviz.model_edge('b', 'c', label='renamed.txt')
+        added = gitviz.model_edge('a', 'c', style='dotted')
+        self.assertDelta((nodes, [edges[0], relabeled, added]), {
+            'edges_added': [relabeled, added],
+            'edges_removed': [edges[1]],
+        })
+
+    def test_repeated_edges_are_counted(self):
+        nodes, edges = self.old
+        repeated = (nodes, edges + [edges[0]])
+        self.assertDelta(repeated, {'edges_added': [edges[0]]})
+        self.assertEqual(gitviz.model_delta(repeated, self.old), {'edges_removed': [edges[0]]})
+
+
+class DeltaProtocolTest(unittest.TestCase):
+
+    args = ['--format=json']
+
+    def setUp(self):
+        self.repo = repos.make_repo(self)
+        repos.commit(self.repo, {'a.txt': 'a\n', 'dir/b.txt': 'b\n'}, 'first')
+        self.server = gitviz.RenderServer()
+        self.addCleanup(self.server.forget_repo, self.repo.path)
+
+    def request(self, server=None, **request):
+        request.setdefault('id', 1)
+        request.setdefault('repo', self.repo.path)
+        request.setdefault('args', self.args)
+        response = (server or self.server).handle(request)
+        self.assertFalse('error' in response, response.get('error'))
+        return response
+
+    def full_model(self):
+        'A render by a server that has never seen the repository.'
+
+        server = gitviz.RenderServer()
+        try:
+            model = json.loads(self.request(server)['output'])
+        finally:
+            server.forget_repo(self.repo.path)
+        return model['nodes'], model['edges']
+
+    def test_deltas_follow_renders(self):
+        first = self.request(base=None)
+        self.assertTrue('delta' not in first)
+        output = json.loads(first['output'])
+        model = output['nodes'], output['edges']
+
+        repos.commit(self.repo, {'a.txt': 'changed\n', 'c.txt': 'c\n'}, 'second')
+        repos.stage(self.repo, {'dir/b.txt': 'staged\n'})
+        second = self.request(base=first['version'])
+        self.assertTrue('output' not in second)
+        self.assertNotEqual(second['version'], first['version'])
+        model = apply_delta(model, second['delta'])
+        self.assertEqual(normalized(model), normalized(self.full_model()))
+
+        # nothing changed since
+        third = self.request(base=second['version'])
+        self.assertEqual(third['delta'], {})
+
+    def test_stale_base_gets_full_output(self):
+        first = self.request(base=None)
+        self.request(base=first['version'])
+
+        response = self.request(base=first['version'])
+        self.assertTrue('delta' not in response)
+        output = json.loads(response['output'])
+        self.assertEqual(normalized((output['nodes'], output['edges'])), normalized(self.full_model()))
+
+    def test_version_names_args(self):
+        first = self.request(base=None)
+        response = self.request(base=first['version'], args=self.args + ['--no-blobs'])
+        self.assertTrue('delta' not in response)
+        self.assertTrue('output' in response)
+
+    def test_base_needs_json(self):
+        response = self.server.handle(dict(id=1, repo=self.repo.path, args=[], base=None))
+        self.assertTrue(response['error'].startswith('ArgumentError'))
+
+
+if __name__ == '__main__':
+    unittest.main()
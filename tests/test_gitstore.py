@@ -0,0 +1,214 @@
+import dulwich.objects
+import dulwich.pack
+import gitstore
+import os
+import unittest
+
+from tests import repos
+
+
+def write_pack(basename, entries):
+    '''Writes a pack and its index from (obj, base) pairs, in order. Each obj
+    is stored as a delta against base, if it isn't None: an OFS_DELTA if base
+    was written before it, and a REF_DELTA otherwise.'''
+
+    records = []
+    for obj, base in entries:
+        data = obj.as_raw_string()
+        base_sha = None
+        if base is not None:
+            data = dulwich.pack.create_delta(base.as_raw_string(), data)
+            base_sha = base.sha().digest()
+        records.append((obj.type_num, obj.sha().digest(), base_sha, data))
+
+    f = open(basename + '.pack', 'wb')
+    try:
+        offsets, checksum = dulwich.pack.write_pack_data(f, len(records), records)
+    finally:
+        f.close()
+
+    f = open(basename + '.idx', 'wb')
+    try:
+        dulwich.pack.write_pack_index_v2(
+            f, sorted((sha, offset, crc32) for sha, (offset, crc32) in offsets.iteritems()),
+            checksum)
+    finally:
+        f.close()
+    return offsets
+
+def blob(data):
+    return dulwich.objects.Blob.from_string(data)
+
+def write_packed_refs(repo, lines):
+    f = open(os.path.join(repo.controldir(), 'packed-refs'), 'wb')
+    try:
+        f.write(''.join(line + '\n' for line in lines))
+    finally:
+        f.close()
+
+
+class PackHeadersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = repos.make_repo(self)
+        self.basename = os.path.join(self.repo.object_store.pack_dir, 'pack-test')
+
+        lines = ''.join('line %d\n' % i for i in range(100))
+        self.base = blob(lines)
+        self.delta = blob(lines + 'one more\n')
+        self.delta_of_delta = blob(lines + 'one more\nand another\n')
+        self.ref_delta = blob(lines + 'with a base further on\n')
+        self.ref_base = blob(lines.upper())
+        self.tree = dulwich.objects.Tree()
+        self.tree.add('a.txt', 0100644, self.base.id)
+
+        self.offsets = write_pack(self.basename, [
+            (self.base, None),
+            (self.delta, self.base),
+            (self.delta_of_delta, self.delta),
+            (self.ref_delta, self.ref_base),
+            (self.ref_base, None),
+            (self.tree, None),
+        ])
+
+        self.headers = gitstore.PackHeaders(self.basename)
+        self.addCleanup(self.headers.close)
+
+    def offset(self, obj):
+        return self.offsets[obj.sha().digest()][0]
+
+    def test_header_at_full_entry(self):
+        type_num, size, base, data_offset = self.headers.header_at(self.offset(self.base))
+        self.assertEqual(type_num, dulwich.objects.Blob.type_num)
+        self.assertEqual(size, self.base.raw_length())
+        self.assertEqual(base, None)
+
+    def test_header_at_ofs_delta(self):
+        type_num, size, base, data_offset = self.headers.header_at(self.offset(self.delta_of_delta))
+        self.assertEqual(type_num, dulwich.pack.OFS_DELTA)
+        self.assertEqual(base, self.offset(self.delta))
+        delta = dulwich.pack.create_delta(self.delta.as_raw_string(), self.delta_of_delta.as_raw_string())
+        self.assertEqual(size, len(delta))
+
+    def test_header_at_ref_delta(self):
+        type_num, size, base, data_offset = self.headers.header_at(self.offset(self.ref_delta))
+        self.assertEqual(type_num, dulwich.pack.REF_DELTA)
+        self.assertEqual(base, self.ref_base.sha().digest())
+
+    def test_delta_chains_resolve_to_base_type(self):
+        self.assertEqual(dict(self.headers.iter_types()), {
+            self.base.id: 'blob',
+            self.delta.id: 'blob',
+            self.delta_of_delta.id: 'blob',
+            self.ref_delta.id: 'blob',
+            self.ref_base.id: 'blob',
+            self.tree.id: 'tree',
+        })
+
+    def test_resolved_types_are_remembered(self):
+        offset = self.offset(self.delta_of_delta)
+        self.assertEqual(self.headers.type_num_at(offset), dulwich.objects.Blob.type_num)
+        self.assertEqual(self.headers._type_nums[self.offset(self.delta)], dulwich.objects.Blob.type_num)
+
+    def test_base_in_another_pack(self):
+        thin = os.path.join(self.repo.object_store.pack_dir, 'pack-thin')
+        other = blob('not in this pack\n')
+        write_pack(thin, [(blob('not in this pack, but close\n'), other)])
+        headers = gitstore.PackHeaders(thin)
+        try:
+            self.assertEqual([type_name for sha, type_name in headers.iter_types()], [None])
+        finally:
+            headers.close()
+
+    def test_reader_inflates_deltified_blobs(self):
+        reader = gitstore.ObjectReader(self.repo.object_store)
+        self.addCleanup(reader.close)
+
+        prefix = reader.read(self.delta_of_delta.id, 16)
+        self.assertEqual(prefix.size, self.delta_of_delta.raw_length())
+        self.assertEqual(prefix.data, self.delta_of_delta.as_raw_string()[:16])
+
+        prefix = reader.read(self.base.id, 16)
+        self.assertEqual(prefix.data, self.base.as_raw_string()[:16])
+        self.assertEqual(reader.objects_read, {'blob': 2})
+
+
+class ReadRefsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = repos.make_repo(self)
+        self.commit = repos.commit(self.repo, {'a.txt': 'a\n'})
+
+        self.tag = dulwich.objects.Tag()
+        self.tag.name = 'v1'
+        self.tag.object = (dulwich.objects.Commit, self.commit)
+        self.tag.tagger = repos.AUTHOR
+        self.tag.tag_time = repos.START_TIME
+        self.tag.tag_timezone = 0
+        self.tag.message = 'version 1\n'
+        self.repo.object_store.add_object(self.tag)
+
+        self.packed_refs = os.path.join(self.repo.controldir(), 'packed-refs')
+
+    def test_peeled_lines(self):
+        write_packed_refs(self.repo, [
+            '%s refs/heads/master' % self.commit,
+            '%s refs/tags/v1' % self.tag.id,
+            '^%s' % self.commit,
+        ])
+        self.assertEqual(gitstore.read_packed_refs(self.packed_refs), {
+            'refs/heads/master': (self.commit, None),
+            'refs/tags/v1': (self.tag.id, self.commit),
+        })
+
+    def test_peeled_trait(self):
+        # with 'peeled', a tag without a ^ line isn't annotated, but other
+        # refs still might be.
+        write_packed_refs(self.repo, [
+            '# pack-refs with: peeled ',
+            '%s refs/heads/master' % self.commit,
+            '%s refs/tags/light' % self.commit,
+            '%s refs/tags/v1' % self.tag.id,
+            '^%s' % self.commit,
+        ])
+        self.assertEqual(gitstore.read_packed_refs(self.packed_refs), {
+            'refs/heads/master': (self.commit, None),
+            'refs/tags/light': (self.commit, self.commit),
+            'refs/tags/v1': (self.tag.id, self.commit),
+        })
+
+    def test_fully_peeled_trait(self):
+        write_packed_refs(self.repo, [
+            '# pack-refs with: peeled fully-peeled ',
+            '%s refs/heads/master' % self.commit,
+            '%s refs/tags/v1' % self.tag.id,
+            '^%s' % self.commit,
+        ])
+        self.assertEqual(gitstore.read_packed_refs(self.packed_refs), {
+            'refs/heads/master': (self.commit, self.commit),
+            'refs/tags/v1': (self.tag.id, self.commit),
+        })
+
+    def test_missing_file(self):
+        self.assertEqual(gitstore.read_packed_refs(self.packed_refs), {})
+
+    def test_loose_refs_take_precedence(self):
+        write_packed_refs(self.repo, [
+            '# pack-refs with: peeled fully-peeled ',
+            '%s refs/heads/master' % self.tag.id,
+            '%s refs/tags/v1' % self.tag.id,
+            '^%s' % self.commit,
+        ])
+        self.repo.refs['refs/heads/master'] = self.commit
+        self.repo.refs.set_symbolic_ref('refs/heads/alias', 'refs/tags/v1')
+        self.repo.refs.set_symbolic_ref('refs/heads/dangling', 'refs/heads/nothing')
+
+        self.assertEqual(gitstore.read_refs(self.repo.controldir()), {
+            'refs/heads/master': (self.commit, None),
+            'refs/heads/alias': (self.tag.id, self.commit),
+            'refs/tags/v1': (self.tag.id, self.commit),
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import gitviz
+import unittest
+
+from tests import repos
+
+
+class IndexChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = repos.make_repo(self)
+        repos.commit(self.repo, {'a.txt': 'a\n', 'dir/b.txt': 'b\n', 'dir/sub/c.txt': 'c\n'}, 'first')
+        self.index_changes = gitviz.IndexChanges()
+
+    def head_tree(self):
+        return self.repo[self.repo.head()].tree
+
+    def get(self, tree=None):
+        if tree is None:
+            tree = self.head_tree()
+        return self.index_changes.get(self.repo, tree, self.repo.object_store)
+
+    def expected(self, tree=None):
+        'What dulwich finds by comparing the whole index with the tree.'
+
+        if tree is None:
+            tree = self.head_tree()
+        index = self.repo.open_index()
+        changes = index.changes_from_tree(self.repo.object_store, tree)
+        return sorted(changes, key=lambda ((oldpath, newpath), modes, shas): newpath or oldpath)
+
+    def forbid_reading_index(self):
+        def open_index():
+            self.fail('the index was read again')
+        self.repo.open_index = open_index
+
+    def test_clean_index(self):
+        self.assertEqual(self.get(), [])
+
+    def test_staged_changes(self):
+        repos.stage(self.repo, {'a.txt': 'changed\n', 'dir/new.txt': 'new\n'})
+        changes = self.get()
+        self.assertEqual([paths for paths, modes, shas in changes], [('a.txt', 'a.txt'), (None, 'dir/new.txt')])
+        self.assertEqual(changes, self.expected())
+
+    def test_unchanged_index_is_not_read(self):
+        repos.stage(self.repo, {'a.txt': 'changed\n'})
+        changes = self.get()
+
+        self.forbid_reading_index()
+        self.assertEqual(self.get(), changes)
+
+    def test_index_stat_change_reads_index(self):
+        self.assertEqual(self.get(), [])
+
+        repos.stage(self.repo, {'dir/sub/c.txt': 'changed\n'})
+        self.assertEqual(self.get(), self.expected())
+        self.assertEqual(len(self.get()), 1)
+
+        # and back again
+        repos.stage(self.repo, {'dir/sub/c.txt': 'c\n'})
+        self.assertEqual(self.get(), [])
+
+    def test_head_tree_change_without_index_change(self):
+        first_tree = self.head_tree()
+        self.assertEqual(self.get(), [])
+        repos.commit(self.repo, {'dir/sub/c.txt': 'changed\n', 'd.txt': 'd\n'}, 'second')
+        self.assertEqual(self.get(), [])
+
+        # the index is unchanged from here, so only the tree diff tells
+        # what differs from the first commit.
+        self.forbid_reading_index()
+        changes = self.get(first_tree)
+        self.assertEqual([paths for paths, modes, shas in changes], [(None, 'd.txt'), ('dir/sub/c.txt', 'dir/sub/c.txt')])
+
+        self.assertEqual(self.get(), [])
+
+    def test_head_tree_and_index_change(self):
+        self.assertEqual(self.get(), [])
+        repos.commit(self.repo, {'dir/b.txt': 'changed\n'}, 'second')
+        repos.stage(self.repo, {'a.txt': 'changed\n'})
+
+        self.assertEqual(self.get(), self.expected())
+        self.assertEqual(len(self.get()), 1)
+
+    def test_no_head_tree(self):
+        # as in a repository with nothing committed yet
+        changes = self.index_changes.get(self.repo, None, self.repo.object_store)
+        self.assertEqual(sorted(paths for paths, modes, shas in changes),
+                         [(None, 'a.txt'), (None, 'dir/b.txt'), (None, 'dir/sub/c.txt')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import pickle
+import pydot
+import unittest
+
+
+class SlottedElementsTest(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(pydot.Node('a'), '__dict__'))
+        self.assertFalse(hasattr(pydot.Edge('a', 'b'), '__dict__'))
+
+    def test_accessors_are_defined_on_the_class(self):
+        self.assertTrue('set_label' in pydot.Node.__dict__)
+        self.assertTrue('get_color' in pydot.Edge.__dict__)
+        self.assertTrue('set_rankdir' in pydot.Graph.__dict__)
+        self.assertTrue('set_label' in pydot.Cluster.__dict__)
+
+    def test_accessors(self):
+        node = pydot.Node('a', shape='box')
+        node.set_label('"A"')
+        self.assertEqual(node.get_label(), '"A"')
+        self.assertEqual(node.get_shape(), 'box')
+        self.assertEqual(node.get_attributes(), {'shape': 'box', 'label': '"A"'})
+
+        edge = pydot.Edge('a', 'b')
+        edge.set_style('dotted')
+        self.assertEqual(edge.get_style(), 'dotted')
+        self.assertEqual(edge.get_color(), None)
+        self.assertEqual(edge.to_string(), 'a -- b  [style=dotted];')
+
+    def test_accessors_are_per_instance(self):
+        a, b = pydot.Node('a'), pydot.Node('b')
+        a.set_color('red')
+        self.assertEqual(a.get_color(), 'red')
+        self.assertEqual(b.get_color(), None)
+
+    def test_create_attribute_methods(self):
+        node = pydot.Node('a')
+        node.create_attribute_methods(['made_up'])
+        node.set_made_up('1')
+        self.assertEqual(node.get_made_up(), '1')
+        self.assertEqual(pydot.Node('b').get_made_up(), None)
+
+    def test_pickle(self):
+        node = pickle.loads(pickle.dumps(pydot.Node('a', label='"A"')))
+        self.assertEqual(node.get_name(), 'a')
+        self.assertEqual(node.get_label(), '"A"')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import gitviz
+import os
+import time
+import unittest
+
+from tests import repos
+
+
+class RepoGraphScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = repos.make_repo(self)
+        repos.commit(self.repo, {'a.txt': 'a\n', 'dir/b.txt': 'b\n'}, 'first')
+        options, _ = gitviz.make_option_parser().parse_args([])
+        self.repo_graph = gitviz.RepoGraph(self.repo, options)
+        self.addCleanup(self.repo_graph.close)
+        self.repo_graph.reset()
+
+    def scanned_shas(self, first=False):
+        new_objects = self.repo_graph.scan(first)
+        self.assertNotEqual(new_objects, None)
+        return set(sha for sha, type_name in new_objects)
+
+    def loose_dir(self, sha):
+        return os.path.join(self.repo.object_store.path, sha[:2])
+
+    def add_without_touching_dir(self, blob):
+        'Adds a loose object, and puts its fan-out directory mtime back.'
+
+        path = self.loose_dir(blob.id)
+        st = os.stat(path)
+        self.repo.object_store.add_object(blob)
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+    def set_loose_dir_mtimes(self, mtime):
+        for dirname in os.listdir(self.repo.object_store.path):
+            if len(dirname) != 2: continue
+            os.utime(os.path.join(self.repo.object_store.path, dirname), (mtime, mtime))
+
+    def test_first_scan_finds_every_object(self):
+        self.assertEqual(self.scanned_shas(first=True), set(self.repo.object_store))
+
+    def test_scan_only_finds_new_objects(self):
+        self.scanned_shas(first=True)
+        self.assertEqual(self.scanned_shas(), set())
+
+        head = repos.commit(self.repo, {'a.txt': 'changed\n'}, 'second')
+        new_shas = self.scanned_shas()
+        self.assertTrue(head in new_shas)
+        self.assertTrue(self.repo[head].tree in new_shas)
+        self.assertEqual(self.scanned_shas(), set())
+
+    def test_racy_dir_is_listed_again(self):
+        # a directory written in the same second as the last scan started
+        # may change again without its mtime changing.
+        self.set_loose_dir_mtimes(int(time.time()) + 1)
+        self.scanned_shas(first=True)
+        sha = self.repo.head()
+        blob = repos.blob_in_dir(sha[:2])
+        self.add_without_touching_dir(blob)
+
+        self.assertEqual(self.scanned_shas(), set([blob.id]))
+
+    def test_old_dir_with_same_mtime_is_skipped(self):
+        self.set_loose_dir_mtimes(int(time.time()) - 60)
+        self.scanned_shas(first=True)
+        sha = self.repo.head()
+        blob = repos.blob_in_dir(sha[:2])
+        self.add_without_touching_dir(blob)
+
+        # its mtime is older than the last scan, so it is trusted.
+        self.assertEqual(self.scanned_shas(), set())
+
+    def test_packed_objects_are_not_vanished(self):
+        self.scanned_shas(first=True)
+        objstore = self.repo.object_store
+        shas = list(objstore)
+        objstore.add_objects([(objstore[sha], None) for sha in shas])
+        for sha in shas:
+            os.remove(os.path.join(self.loose_dir(sha), sha[2:]))
+
+        # the new pack's objects are all new to the scan, but nothing is
+        # missing, so it doesn't start over.
+        self.assertEqual(self.scanned_shas(), set(shas))
+
+    def test_removed_objects_start_over(self):
+        self.scanned_shas(first=True)
+        sha = self.repo.head()
+        os.remove(os.path.join(self.loose_dir(sha), sha[2:]))
+
+        self.assertEqual(self.repo_graph.scan(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()